@@ -0,0 +1,133 @@
+"""
+Adaptive sampling of a point source fan. An even fan only finds small receivers when it is very dense,
+adaptive_fan starts from a coarse fan and only splits the angle between two neighbouring rays
+where their bounce trees differ, so rays are spent where the paths change and not on open walls
+"""
+from collections import deque
+import numpy as np
+from block import Map, Ray, Receiver
+from link_budget import LinkBudget
+from tracer import find_direction, get_all_rays
+
+
+def _block_index(room_map: Map, block):
+    return -1 if block is None else room_map.block_indices[id(block)]
+
+
+def tree_signature(room_map: Map, rays):
+    """
+    What a get_all_rays list reaches: the boundary hit and the medium of every ray in order (None for
+    the empty child slots, so the shape of the tree counts too) and the receivers it is incident on.
+    Neighbouring rays with equal signatures took the same paths
+    """
+    path = tuple(None if ray is None else (ray.edge_index, _block_index(room_map, ray.medium)) for ray in rays)
+    rays = [ray for ray in rays if ray is not None]
+    receivers = set()
+    if rays and isinstance(rays[0].medium, Receiver):
+        receivers.add(_block_index(room_map, rays[0].medium))
+    for ray in rays:
+        if isinstance(ray.hit_block, Receiver) and ray.hit_block is not ray.medium:
+            receivers.add(_block_index(room_map, ray.hit_block))
+    return path, frozenset(receivers)
+
+
+def beam_holds_vertex(room_map: Map, rays_a, rays_b):
+    """
+    True when a boundary vertex lies inside the beam between matching rays of two trees with equal signatures,
+    i.e. the quadrilateral from the start to the end of one ray and back along the other. Something
+    smaller than the gap (a receiver in front of a wall both rays hit) can only hide there
+    """
+    pairs = [(a, b) for a, b in zip(rays_a, rays_b) if a is not None and b is not None]
+    if not pairs or len(room_map.edge_starts) == 0:
+        return False
+    rays_a, rays_b = zip(*pairs)
+    starts_a = np.array([ray.start_point for ray in rays_a], dtype=float)
+    ends_a = np.array([ray.end_point for ray in rays_a], dtype=float)
+    starts_b = np.array([ray.start_point for ray in rays_b], dtype=float)
+    ends_b = np.array([ray.end_point for ray in rays_b], dtype=float)
+    corners = np.stack([starts_a, ends_a, ends_b, starts_b], axis=1)
+    sides = np.roll(corners, -1, axis=1) - corners
+    lengths = np.hypot(sides[..., 0], sides[..., 1])
+    # Orientation of each quadrilateral so inside is the positive side of every edge
+    area = np.sum(corners[..., 0] * np.roll(corners[..., 1], -1, axis=1)
+                  - np.roll(corners[..., 0], -1, axis=1) * corners[..., 1], axis=1)
+    offsets = room_map.edge_starts[None, None] - corners[:, :, None]
+    cross = sides[..., 0, None] * offsets[..., 1] - sides[..., 1, None] * offsets[..., 0]
+    cross *= np.sign(area)[:, None, None]
+    # Vertices on a side, like the ends of the boundary a reflected beam starts from, don't count.
+    # Sides of zero length (the shared origin of the head rays) leave a triangle
+    degenerate = (lengths < 1e-9)[..., None]
+    inside = np.all(degenerate | (cross > 1e-7 * lengths[..., None]), axis=1)
+    return bool(np.any(inside))
+
+
+class AdaptiveFan:
+    """
+    The samples of adaptive_fan in angle order: angles in degrees, the get_all_rays list of each sample,
+    widths, the degrees of the circle each sample stands for, and a LinkBudget whose sources are sample indices.
+    Every sample is fired with the same power, scale by widths / 360 to compare powers with an even fan
+    """
+    def __init__(self, angles, trees, widths, budget: LinkBudget):
+        self.angles = angles
+        self.trees = trees
+        self.widths = widths
+        self.budget = budget
+
+    def __len__(self):
+        return len(self.angles)
+
+    def __repr__(self):
+        return f"AdaptiveFan({len(self)} rays, {len(self.budget.hit_receivers())} receivers hit)"
+
+    @property
+    def directions(self):
+        return np.array([find_direction(angle) for angle in self.angles]).reshape(-1, 2)
+
+
+def adaptive_fan(room_map: Map, origin, rays=36, angle=0, max_level=12, max_rays=10000, iterations=3,
+                 power_threshold=0, power=1, check_vertices=True) -> AdaptiveFan:
+    """
+    Fires an even fan of rays starting at angle (degrees) from origin, then keeps halving the angle between
+    neighbouring rays whose tree_signature differs, or whose beam holds a boundary vertex with check_vertices,
+    up to max_level times or until max_rays have been traced. Coarser gaps are always split first.
+    Each sample is traced with get_all_rays, iterations and power_threshold prune its tree as they do there
+    """
+    origin = np.asarray(origin, dtype=float)
+    budget = LinkBudget(room_map)
+    angles, trees, signatures = [], [], []
+
+    def sample(sample_angle):
+        tree = get_all_rays(Ray(find_direction(sample_angle), power, origin, room_map), iterations,
+                            power_threshold, budget=budget, source=len(angles))
+        angles.append(sample_angle)
+        trees.append(tree)
+        signatures.append(tree_signature(room_map, tree))
+        return len(angles) - 1
+
+    step = 360 / rays
+    first = [sample(angle + step * i) for i in range(rays)]
+    # (sample at the low end, sample at the high end, angle of the high end, times split)
+    gaps = deque((first[i], first[(i + 1) % rays], angle + step * (i + 1), 0) for i in range(rays))
+    while gaps and len(angles) < max_rays:
+        lo, hi, hi_angle, level = gaps.popleft()
+        if level >= max_level:
+            continue
+        same = signatures[lo] == signatures[hi]
+        if same and not (check_vertices and beam_holds_vertex(room_map, trees[lo], trees[hi])):
+            continue
+        middle_angle = (angles[lo] + hi_angle) / 2
+        middle = sample(middle_angle)
+        gaps.append((lo, middle, middle_angle, level + 1))
+        gaps.append((middle, hi, hi_angle, level + 1))
+
+    order = np.argsort(angles, kind="stable")
+    sorted_angles = np.array(angles)[order]
+    gaps_after = np.diff(np.append(sorted_angles, sorted_angles[0] + 360))
+    widths = (gaps_after + np.roll(gaps_after, 1)) / 2
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order))
+    paths = budget.paths()
+    paths["source"] = rank[paths["source"]]
+    result = LinkBudget(room_map)
+    result.record_paths(paths)
+    return AdaptiveFan(sorted_angles, [trees[i] for i in order], widths, result)
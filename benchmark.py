@@ -0,0 +1,290 @@
+"""
+Benchmarks for the tracing hot paths. Every benchmark runs on synthetic_map scenes for each
+combination of edge and ray counts and reports throughput, latency percentiles and peak memory as JSON.
+
+    python benchmark.py --edges 10 100 1000 10000 --rays 1 100 10000 --output results.json
+
+Latencies are per call: one ray for the Ray benchmarks, one head ray's whole tree for get_all_rays
+and one frame for the others. Throughput counts the segments each call produces, and counts one per
+query for collision and block_enclosed. Calls stop once a case has run for --time-limit seconds.
+Peak memory comes from a second pass over the same calls under tracemalloc, so tracing overhead
+never shows up in the timings. Runs with the same --seed build the same scenes and rays.
+The Ray benchmarks only use block.py and tracer.py, so this file also runs on older versions of the tracer
+for a before and after comparison, benchmarks whose modules are missing are skipped
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from block import Block, Map, Ray, Receiver
+from tracer import get_all_rays
+
+# Transmitters in the frame benchmarks move this far or turn this many degrees every frame, like the demos
+MOVE_SPEED = 10
+TURN_SPEED = 1
+
+
+def synthetic_map(num_edges=100, seed=0, size=1000, accelerator=None):
+    """
+    A square room of side size filled with random convex polygons, num_edges boundaries in total
+    (at least 7). The polygons sit one per cell of a square grid and never overlap, so the grid lines
+    (multiples of synthetic_cell) are free space. Every tenth polygon is a Receiver and every other
+    polygon splits power with the Fresnel equations
+    """
+    rng = np.random.default_rng(seed)
+    room = Block("room", 1, (0, 0, 0, 127), 0, 1, ((0, 0), (size, 0), (size, size), (0, size)))
+    num_blocks = max(1, (num_edges - 4) // 6)
+    sides = np.full(num_blocks, 3)
+    # Share out the remaining edges as evenly as possible
+    sides += (num_edges - 4 - 3 * num_blocks) // num_blocks
+    sides[:(num_edges - 4 - 3 * num_blocks) % num_blocks] += 1
+    cell = synthetic_cell(num_edges, size)
+    per_row = int(round(size / cell)) - 1
+    blocks = []
+    for i, num_sides in enumerate(sides):
+        centre = cell * (np.array([i % per_row, i // per_row]) + 1.5)
+        angles = rng.uniform(0, 2 * np.pi) + np.sort(rng.uniform(0, 2 * np.pi, num_sides))
+        # Evenly spread angles would look too regular, sorted random ones keep the polygon convex
+        radius = rng.uniform(0.15, 0.35) * cell
+        vertices = [tuple(centre + radius * np.array([np.cos(a), np.sin(a)])) for a in angles]
+        reflectivity = None if i % 2 else 0.5
+        if i % 10 == 9:
+            blocks.append(Receiver(f"receiver{i}", 1.5, (0, 255, 0, 127), (0, 100, 0, 127), 0.01, reflectivity,
+                                   vertices))
+        else:
+            blocks.append(Block(f"block{i}", 1.5, (255, 0, 0, 127), 0.01, reflectivity, vertices))
+    if accelerator is None:
+        # Maps from before the accelerators were added don't take the argument
+        return Map(*blocks, room)
+    return Map(*blocks, room, accelerator=accelerator)
+
+
+def synthetic_cell(num_edges, size=1000):
+    """Grid spacing of synthetic_map, the polygons are centred between the grid lines"""
+    num_blocks = max(1, (num_edges - 4) // 6)
+    per_row = int(np.ceil(np.sqrt(num_blocks)))
+    return size / (per_row + 1)
+
+
+def _fan(num_rays, offset=0):
+    """Unit directions spread evenly over 360 degrees"""
+    angles = np.radians(offset + 360 / num_rays * np.arange(num_rays))
+    return np.stack([np.cos(angles), np.sin(angles)], axis=1)
+
+
+def _free_points(room_map, num_points, rng):
+    """Random points on the free grid lines of a synthetic_map, with random unit directions"""
+    num_edges = len(room_map.boundaries)
+    cell = synthetic_cell(num_edges)
+    lines = rng.integers(1, int(round(1000 / cell)), num_points) * cell
+    along = rng.uniform(1, 999, num_points)
+    points = np.where(rng.random(num_points)[:, None] < 0.5, np.stack([lines, along], axis=1),
+                      np.stack([along, lines], axis=1))
+    angles = rng.uniform(0, 2 * np.pi, num_points)
+    return points, np.stack([np.cos(angles), np.sin(angles)], axis=1)
+
+
+def collision(room_map, num_rays, rng, **settings):
+    points, directions = _free_points(room_map, num_rays, rng)
+    rays = [Ray(direction, 1, point, room_map) for point, direction in zip(points, directions)]
+
+    def call(ray):
+        ray.collision()
+        return 1
+    return len(rays), lambda i: rays[i], call
+
+
+def block_enclosed(room_map, num_rays, rng, **settings):
+    points = rng.uniform(0, 1000, (num_rays, 2))
+    directions = _fan(max(num_rays, 1))
+
+    def call(i):
+        room_map.block_enclosed(points[i], directions[i])
+        return 1
+    return num_rays, lambda i: i, call
+
+
+def reflect(room_map, num_rays, rng, **settings):
+    points, directions = _free_points(room_map, num_rays, rng)
+    return num_rays, lambda i: Ray(directions[i], 1, points[i], room_map), lambda ray: ray.reflect() is not None
+
+
+def refract(room_map, num_rays, rng, **settings):
+    points, directions = _free_points(room_map, num_rays, rng)
+    return num_rays, lambda i: Ray(directions[i], 1, points[i], room_map), lambda ray: ray.refract() is not None
+
+
+def _get_all_rays(depth):
+    def benchmark(room_map, num_rays, rng, **settings):
+        points, directions = _free_points(room_map, num_rays, rng)
+
+        def call(i):
+            rays = get_all_rays(Ray(directions[i], 1, points[i], room_map), iterations=depth)
+            return sum(ray is not None for ray in rays)
+        return num_rays, lambda i: i, call
+    return benchmark
+
+
+def _start(room_map):
+    """A free point near the middle of a synthetic_map"""
+    cell = synthetic_cell(len(room_map.boundaries))
+    return np.array([cell, cell * max(1, int(500 // cell))], dtype=float)
+
+
+def packet(room_map, num_rays, rng, frames=30, iterations=3, **settings):
+    from packet import trace_packet
+    directions = _fan(num_rays)
+    origins = np.broadcast_to(_start(room_map), directions.shape)
+    return frames, lambda i: i, lambda i: len(trace_packet(room_map, origins, directions, iterations=iterations))
+
+
+def point_source_frame(room_map, num_rays, rng, frames=30, iterations=3, **settings):
+    """The per frame work of point_source.py: a fan from one transmitter that moves and turns"""
+    from session import TraceSession
+    from link_budget import LinkBudget
+    session = TraceSession(room_map, iterations)
+    budget = LinkBudget(room_map)
+    start = _start(room_map)
+
+    def call(i):
+        # Move along the free grid line and turn on alternate frames
+        origin = start + [MOVE_SPEED * (i // 2), 0]
+        directions = _fan(num_rays, TURN_SPEED * ((i + 1) // 2))
+        segments = session.trace(np.broadcast_to(origin, directions.shape), directions)
+        budget.reset()
+        budget.record_segments(segments)
+        return len(segments)
+    return frames, lambda i: i, call
+
+
+def parallel_rays_frame(room_map, num_rays, rng, frames=30, iterations=3, **settings):
+    """The per frame work of parallel_rays.py: a beam of parallel rays that moves and turns"""
+    from session import TraceSession
+    from link_budget import LinkBudget
+    session = TraceSession(room_map, iterations)
+    budget = LinkBudget(room_map)
+    start = _start(room_map)
+    offsets = np.stack([np.zeros(num_rays), np.linspace(-100, 100, num_rays)], axis=1)
+
+    def call(i):
+        origins = start + offsets + [MOVE_SPEED * (i // 2), 0]
+        angle = np.radians(TURN_SPEED * ((i + 1) // 2))
+        directions = np.tile([np.cos(angle), np.sin(angle)], (num_rays, 1))
+        segments = session.trace(origins, directions)
+        budget.reset()
+        budget.record_segments(segments)
+        return len(segments)
+    return frames, lambda i: i, call
+
+
+BENCHMARKS = {
+    "collision": collision,
+    "block_enclosed": block_enclosed,
+    "reflect": reflect,
+    "refract": refract,
+    "get_all_rays_1": _get_all_rays(1),
+    "get_all_rays_3": _get_all_rays(3),
+    "get_all_rays_5": _get_all_rays(5),
+    "packet": packet,
+    "point_source_frame": point_source_frame,
+    "parallel_rays_frame": parallel_rays_frame,
+}
+
+
+def run_case(benchmark, room_map, num_rays, seed, time_limit, **settings):
+    """Runs one benchmark on one scene. Returns a dict of results"""
+    count, prepare, call = BENCHMARKS[benchmark](room_map, num_rays, np.random.default_rng(seed), **settings)
+    latencies = []
+    segments = 0
+    deadline = time.perf_counter() + time_limit
+    for i in range(count):
+        args = prepare(i)
+        started = time.perf_counter()
+        segments += call(args)
+        finished = time.perf_counter()
+        latencies.append(finished - started)
+        if finished > deadline:
+            break
+
+    # Same calls again for the memory peak, on a fresh setup so stateful benchmarks repeat themselves
+    count, prepare, call = BENCHMARKS[benchmark](room_map, num_rays, np.random.default_rng(seed), **settings)
+    tracemalloc.start()
+    for i in range(len(latencies)):
+        call(prepare(i))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = np.array(latencies)
+    total = float(latencies.sum())
+    return {
+        "benchmark": benchmark,
+        "edges": len(room_map.boundaries),
+        "rays": num_rays,
+        "calls": len(latencies),
+        "segments": int(segments),
+        "seconds": total,
+        "segments_per_second": segments / total if total > 0 else None,
+        "latency_us": {name: float(np.percentile(latencies, q) * 1e6) if len(latencies) else None
+                       for name, q in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))},
+        "peak_memory_bytes": int(peak),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the tracer on synthetic scenes and write JSON")
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--edges", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--rays", type=int, nargs="+", default=[1, 100, 10000])
+    parser.add_argument("--frames", type=int, default=30, help="calls for the packet and frame benchmarks")
+    parser.add_argument("--iterations", type=int, default=3, help="bounce depth for the packet and frame benchmarks")
+    parser.add_argument("--time-limit", type=float, default=2.0, help="seconds each case may run for")
+    parser.add_argument("--accelerator", choices=["bvh", "grid"], default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="path of the .json file to write, stdout when left out")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    results = []
+    for num_edges in args.edges:
+        room_map = synthetic_map(num_edges, args.seed, accelerator=args.accelerator)
+        for num_rays in args.rays:
+            for benchmark in args.benchmarks:
+                try:
+                    result = run_case(benchmark, room_map, num_rays, args.seed, args.time_limit,
+                                      frames=args.frames, iterations=args.iterations)
+                except ImportError as error:
+                    print(f"{benchmark} skipped: {error}", file=sys.stderr)
+                    continue
+                print(f"{benchmark} edges={num_edges} rays={num_rays}: "
+                      f"{result['segments_per_second'] or 0:.0f} segments/s, "
+                      f"p50 {result['latency_us']['p50'] or 0:.0f} us", file=sys.stderr)
+                results.append(result)
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "accelerator": args.accelerator,
+        "seed": args.seed,
+        "time_limit": args.time_limit,
+        "frames": args.frames,
+        "iterations": args.iterations,
+        "results": results,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
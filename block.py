@@ -1,21 +1,42 @@
 import numpy as np
-from numpy.linalg import LinAlgError
-import pygame
+import profiler
+from optics import reflect, refract, fresnel_reflectance, absorb
+from intersect import pack_edges, edge_params, line_params, valid_hits, nearest_hit, nearest_hits
+from containment import BOX_TOLERANCE, ContainmentIndex, touching_edges, edge_media
+from bvh import BVH
+from grid import UniformGrid
 
 
 class Line:
     """
     A Line represented in vectors. 
     start point is where the line starts, and direction is a vector parallel to the line
-    in form START + n DIRECTION where n is the parameter
+    in form START + n DIRECTION where n is the parameter.
+    unit_direction, normal and unit_normal are worked out the first time they are used
     """
+    __slots__ = ("start_point", "direction", "_unit_direction", "_normal", "_unit_normal")
+
     def __init__(self, start_point, direction):
         self.start_point = np.array(start_point)
         self.direction = np.array(direction)
-        self.unit_direction = direction / np.linalg.norm(direction)
-        self.normal = self.find_normal()
-        self.unit_normal = self.normal / np.linalg.norm(self.normal)
-        self.line = np.array([self.start_point, self.direction])
+        self._unit_direction = None
+        self._normal = None
+        self._unit_normal = None
+    @property
+    def unit_direction(self):
+        if self._unit_direction is None:
+            self._unit_direction = self.direction / np.linalg.norm(self.direction)
+        return self._unit_direction
+    @property
+    def normal(self):
+        if self._normal is None:
+            self._normal = self.find_normal()
+        return self._normal
+    @property
+    def unit_normal(self):
+        if self._unit_normal is None:
+            self._unit_normal = self.normal / np.linalg.norm(self.normal)
+        return self._unit_normal
     def find_normal(self):
         """Uses the direction vector to find a normal"""
         normal_x_direction = -self.direction[1]
@@ -32,16 +53,11 @@ class Line:
         param[0] has the n param for the current line
         param[1] has the n param for the incoming line
         """
-        sub_vector = self.start_point - line2.start_point
-        dir_matrix = np.array([line2.direction, -1 * self.direction]).transpose()
-        try:
-            dir_matrix_inv = np.linalg.inv(dir_matrix)
-        except LinAlgError:
+        param = line_params(self.start_point, self.direction, line2.start_point, line2.direction)
+        if param is None:
             # No solution --> Non intersecting
             return None
-        param = dir_matrix_inv.dot(sub_vector)
-        param[0], param[1] = param[1], param[0]
-        return param
+        return np.array(param)
     def intersecting_point(self, line2):
         """Only returns the param of the incoming line"""
         intersection = self.find_line_intersection(line2)
@@ -49,30 +65,27 @@ class Line:
             return None
         return self.find_intersection_point(intersection[0])
     def reflect_ray(self, line_boundary):
-        """reflect itself on a line boundary"""
-        intersection = self.intersecting_point(line_boundary)
-        if intersection is None:
-            return
-        # Find a line perpendicular to the boundary and intersect current line
-        # Can't intersect line at the intersection of boundary and line
-        perp_line = Line(self.start_point, line_boundary.unit_normal)
-        perp_intersection = perp_line.find_line_intersection(line_boundary)
-        if perp_intersection is None:
+        """
+        reflect itself on a line boundary.
+        The reflected direction is as long as the path from the start to the boundary
+        """
+        param = line_params(self.start_point, self.direction, line_boundary.start_point, line_boundary.direction)
+        if param is None:
+            # Parallel to the boundary, never hits it
             return None
-        reflected_start = perp_line.find_intersection_point(2*perp_intersection[0])
-        reflected_direction = intersection - reflected_start
-        return reflected_direction
+        dx, dy = self.direction.tolist()
+        nx, ny = line_boundary.unit_normal.tolist()
+        reflected_x, reflected_y = reflect(dx, dy, nx, ny)
+        return np.array([param[0] * reflected_x, param[0] * reflected_y])
     def change_direction(self, direction):
         """For rotating the line"""
         self.direction = direction
-        self.unit_direction = direction / np.linalg.norm(direction)
-        self.normal = self.find_normal()
-        self.unit_normal = self.normal / np.linalg.norm(self.normal)
-        self.line = np.array([self.start_point, self.direction])
+        self._unit_direction = None
+        self._normal = None
+        self._unit_normal = None
     def change_start(self, new_start):
         """For moving the line"""
         self.start_point = np.array(new_start)
-        self.line = np.array([self.start_point, self.direction])
     def __repr__(self):
         return f"Starting point {self.start_point} direction {self.direction}"
 
@@ -82,8 +95,9 @@ class Boundary(Line):
     """
     A more specialized line for making boundaries.
     The boundary will start with n param = 0 and end at n param = 1 (see Line docstring)
-    Also has draw onto surface functions
     """
+    __slots__ = ("start_coordinates", "end_coordinates", "colour", "reflectivity")
+
     def __init__(self, start_coordinates, end_coordinates, colour, reflectivity):
         self.start_coordinates = np.array(start_coordinates)
         self.end_coordinates = np.array(end_coordinates)
@@ -92,10 +106,6 @@ class Boundary(Line):
         self.colour = colour
         self.reflectivity = reflectivity
 
-    def draw_boundary(self, surface):
-        """draws the boundary onto the surface"""
-        pygame.draw.line(surface, self.colour, self.start_coordinates, self.end_coordinates, 1)
-
     def boundary_intersection(self, line):
         """returns what n param it takes for the incoming line to hit the boundary"""
         param = line.find_line_intersection(self)
@@ -108,7 +118,9 @@ class Boundary(Line):
 
 class Block:
     """
-    Block class refers to an object displayed on screen
+    Block class refers to an object displayed on screen.
+    reflectivity is the fraction of power its edges reflect, None to use the Fresnel equations.
+    absorption_coeff is how much power a ray loses per unit length travelled inside it
     """
     def __init__(self, name, refraction_index, colour, absorption_coeff, reflectivity, vertices):
         self.name = name
@@ -126,35 +138,27 @@ class Block:
             next_vertex = (i+1) % num_of_vertices
             edge = Boundary(self.vertices[i], self.vertices[next_vertex], colour, reflectivity)
             self.edges.append(edge)
+
+        # Precomputed for containment tests
+        self.edge_starts, self.edge_directions = pack_edges(self.edges)
+        vertex_array = np.array(self.vertices, dtype=float).reshape(-1, 2)
+        self.box_min = vertex_array.min(axis=0) if num_of_vertices else np.full(2, np.inf)
+        self.box_max = vertex_array.max(axis=0) if num_of_vertices else np.full(2, -np.inf)
+        # Shoelace formula, positive when the vertices go counter clockwise
+        self.signed_area = float(np.sum(self.edge_starts[:, 0] * self.edge_directions[:, 1]
+                                        - self.edge_starts[:, 1] * self.edge_directions[:, 0]) / 2)
     
     def __repr__(self):
         return self.name
 
     def enclosed_point(self, point, direction):
-        point = np.array(point) 
-        # + 0 * np.array(direction)
-        test_line = Line(point, direction)
-        counter = 0
-        for edge in self.edges:
-            intersect = edge.boundary_intersection(test_line)
-            if intersect is None:
-                continue
-            if intersect > 0.01:
-                counter += 1
-        if counter % 2 == 1:
-            return True
-        else:
+        """True when a line from point along direction crosses the edges an odd number of times"""
+        point = np.array(point, dtype=float)
+        if np.any(point < self.box_min - BOX_TOLERANCE) or np.any(point > self.box_max + BOX_TOLERANCE):
             return False
-    
-    def draw_block(self, surface):
-        for edge in self.edges:
-            edge.draw_boundary(surface)
-        lx, ly = zip(*self.vertices)
-        min_x, min_y, max_x, max_y = min(lx), min(ly), max(lx), max(ly)
-        target_rect = pygame.Rect(min_x, min_y, max_x - min_x, max_y - min_y)
-        shape_surf = pygame.Surface(target_rect.size, pygame.SRCALPHA)
-        pygame.draw.polygon(shape_surf, self.colour, [(x - min_x, y-min_y) for x, y in self.vertices])
-        surface.blit(shape_surf, target_rect)
+        t, u = edge_params(point, direction, self.edge_starts, self.edge_directions)
+        counter = np.count_nonzero(valid_hits(t, u))
+        return counter % 2 == 1
 
 
 class Receiver(Block):
@@ -170,11 +174,57 @@ class Receiver(Block):
             self.colour = self.receive_colour
 
 class Map:
-    def __init__(self, *objects):
+    """
+    Holds every block in the scene.
+    accelerator picks how rays search the boundaries:
+    None tests every boundary at once, "bvh" walks a bounding box tree
+    and "grid" marches through a uniform grid of cells.
+    compiled is what compiled() returned for a map of the same blocks, it saves working out the edge tables again
+    """
+    accelerators = {"bvh": BVH, "grid": UniformGrid}
+
+    def __init__(self, *objects, accelerator=None, compiled=None):
         self.boundaries = []
         self.blocks = objects
-        for block in self.blocks:
+        edge_blocks = []
+        for i, block in enumerate(self.blocks):
             self.boundaries += block.edges
+            edge_blocks += [i] * len(block.edges)
+        # Packed copies of the boundaries so a ray can be tested against all of them at once
+        self.edge_starts, self.edge_directions = pack_edges(self.boundaries)
+        self.edge_blocks = np.array(edge_blocks, dtype=int)
+        self.edge_normals = np.array([boundary.unit_normal for boundary in self.boundaries]).reshape(-1, 2)
+        # Boundaries without a reflectivity (None) use the Fresnel equations, stored as nan
+        self.edge_reflectivity = np.array([boundary.reflectivity for boundary in self.boundaries], dtype=float)
+        self.refraction_indices = np.array([block.refraction_index for block in self.blocks], dtype=float)
+        self.absorption_coeffs = np.array([block.absorption_coeff for block in self.blocks], dtype=float)
+        self.containment = ContainmentIndex(self.blocks, self.edge_starts, self.edge_directions, self.edge_blocks)
+        # Which block each boundary belongs to and which blocks lie on either side of it.
+        # edge_media[:, 0] is on the side edge_normals point to. Edges touching another block's edges
+        # can have different blocks along their length, those fall back to a containment query
+        self.boundary_indices = {id(boundary): i for i, boundary in enumerate(self.boundaries)}
+        self.block_indices = {id(block): i for i, block in enumerate(self.blocks)}
+        if compiled is not None and len(compiled["edge_exact"]) != len(self.boundaries):
+            raise ValueError(f"Compiled arrays are for {len(compiled['edge_exact'])} boundaries, "
+                             f"the blocks have {len(self.boundaries)}")
+        if compiled is None:
+            self.edge_media = edge_media(self.containment, self.edge_normals)
+            self.edge_exact = ~touching_edges(self.edge_starts, self.edge_directions, self.edge_blocks)
+        else:
+            self.edge_media = np.asarray(compiled["edge_media"])
+            self.edge_exact = np.asarray(compiled["edge_exact"])
+        self.accelerator = None
+        if accelerator is not None:
+            if accelerator not in self.accelerators:
+                raise ValueError(f"Unknown accelerator {accelerator!r}, expected one of {list(self.accelerators)}")
+            prefix = f"{accelerator}_"
+            built = {} if compiled is None else {name[len(prefix):]: value for name, value in compiled.items()
+                                                 if name.startswith(prefix)}
+            if built:
+                self.accelerator = self.accelerators[accelerator].from_arrays(self.edge_starts, self.edge_directions,
+                                                                              built)
+            else:
+                self.accelerator = self.accelerators[accelerator](self.edge_starts, self.edge_directions)
         self.receivers = []
         self.objects = []
         for obj in objects:
@@ -183,79 +233,171 @@ class Map:
             else:
                 self.objects.append(obj)
 
+    def compiled(self):
+        """
+        The tables that are slow to work out as a dict of arrays. Passing it back as Map(..., compiled=...)
+        with the same blocks and accelerator skips that work, scene_file caches it on disk
+        """
+        arrays = {"edge_media": self.edge_media, "edge_exact": self.edge_exact}
+        if self.accelerator is not None:
+            name = next(name for name, kind in self.accelerators.items() if isinstance(self.accelerator, kind))
+            arrays.update({f"{name}_{field}": value for field, value in self.accelerator.arrays().items()})
+        return arrays
+
+    def nearest_edge(self, start_point, direction):
+        """Index into self.boundaries of the closest boundary in front of the line (-1 for none) and its n param"""
+        with profiler.stage("intersect"):
+            if self.accelerator is not None:
+                return self.accelerator.nearest(start_point, direction)
+            return nearest_hit(start_point, direction, self.edge_starts, self.edge_directions)
+
+    def nearest_boundary(self, start_point, direction):
+        """Returns the closest boundary in front of the line and the n param to reach it"""
+        index, param = self.nearest_edge(start_point, direction)
+        if index < 0:
+            return None, np.inf
+        return self.boundaries[index], param
+
+    def nearest_boundaries(self, start_points, directions):
+        """
+        nearest_boundary for N lines at once.
+        Returns edge indices into self.boundaries (-1 for no hit) and the n params
+        """
+        with profiler.stage("intersect"):
+            if self.accelerator is not None:
+                return self.accelerator.nearest_many(start_points, directions)
+            return nearest_hits(start_points, directions, self.edge_starts, self.edge_directions)
+
+    def blocks_enclosed(self, points, directions):
+        """block_enclosed for N points at once. Returns indices into self.blocks, -1 for none"""
+        with profiler.stage("containment"):
+            return self.containment.blocks_index(points, directions)
+
+    def far_side_block(self, edge, point, direction) -> Block:
+        """The block a ray crossing boundary number edge at point goes into, same as block_enclosed(point, direction)"""
+        if self.edge_exact[edge]:
+            normal = self.edge_normals[edge]
+            index = self.edge_media[edge, 0 if direction[0] * normal[0] + direction[1] * normal[1] > 0 else 1]
+        else:
+            with profiler.stage("containment"):
+                index = self.containment.far_side(edge, point, direction)
+        if index < 0:
+            return None
+        return self.blocks[index]
+
+    def far_side_blocks(self, edges, points, directions):
+        """far_side_block for N hits at once. Returns indices into self.blocks, -1 for none"""
+        sides = np.where(np.einsum("ij,ij->i", directions, self.edge_normals[edges]) > 0, 0, 1)
+        result = self.edge_media[edges, sides]
+        inexact = np.flatnonzero(~self.edge_exact[edges])
+        if len(inexact):
+            with profiler.stage("containment"):
+                result[inexact] = self.containment.blocks_index(points[inexact], directions[inexact], edges[inexact])
+        return result
+
     def block_boundary(self, boundary) -> Block:
         """Checks which block a boundary belongs to"""
-        for block in self.blocks:
-            if boundary in block.edges:
-                return block
-        return None
+        index = self.boundary_indices.get(id(boundary))
+        if index is None:
+            return None
+        return self.blocks[self.edge_blocks[index]]
     
     def block_enclosed(self, point, direction) -> Block:
-        for block in self.blocks:
-            if block.enclosed_point(point, direction):
-                return block
-        return None
+        """The first block enclosing point, see Block.enclosed_point"""
+        with profiler.stage("containment"):
+            index = self.containment.block_index(point, direction)
+        if index < 0:
+            return None
+        return self.blocks[index]
+
 
-    def draw_map(self, surface):
-        for block in self.blocks:
-            block.draw_block(surface)
+# Default for Ray's medium argument, None already means free space
+FIND_MEDIUM = object()
 
 
 class Ray(Line):
-    def __init__(self, direction, starting_power, start_point, room_map:Map):
+    """
+    A ray travelling through the map.
+    power is what the ray starts with, end_power is what is left when it reaches end_point
+    after absorption in its medium (Beer-Lambert law).
+    travelled is the distance from the transmitter to the start of the ray.
+    medium can be passed in when it is already known, as it is for reflected and refracted rays
+    """
+    __slots__ = ("power", "travelled", "room_map", "medium", "hit_block", "edge_index", "shortest_path",
+                 "boundary_hit", "end_point", "path_length", "end_power")
+
+    def __init__(self, direction, starting_power, start_point, room_map:Map, travelled=0, medium=FIND_MEDIUM):
         super().__init__(start_point, direction)
+        profiler.count("rays")
         self.power = starting_power
+        self.travelled = travelled
         self.room_map = room_map
-        self.medium = room_map.block_enclosed(start_point, direction)
-        self.hit_block = None
-        self.boundary_hit, self.shortest_path = self.collision()
+        if medium is FIND_MEDIUM:
+            medium = room_map.block_enclosed(start_point, direction)
+        self.medium = medium
+        self.find_end()
 
+    def find_end(self):
+        """Finds the boundary the ray ends on and the power that gets there"""
+        self.hit_block = None
+        self.edge_index, self.shortest_path = self.room_map.nearest_edge(self.start_point, self.direction)
+        self.boundary_hit = None
         self.end_point = self.start_point + 10000 * self.unit_direction
-        if self.boundary_hit is not None:
+        if self.edge_index >= 0:
+            self.boundary_hit = self.room_map.boundaries[self.edge_index]
             self.end_point = self.find_intersection_point(self.shortest_path)
-            self.hit_block = self.room_map.block_enclosed(self.end_point, self.direction)
+            self.hit_block = self.room_map.far_side_block(self.edge_index, self.end_point, self.direction)
+        self.path_length = float(np.hypot(*(self.end_point - self.start_point)))
+        self.end_power = self.power
+        if self.medium is not None:
+            self.end_power = absorb(self.power, self.medium.absorption_coeff, self.path_length)
 
     def move_start(self, new_start):
         self.change_start(new_start)
         self.medium = self.room_map.block_enclosed(self.start_point, self.direction)
-        self.hit_block = None
-        self.boundary_hit, self.shortest_path = self.collision()
-        self.end_point = self.start_point + 10000 * self.unit_direction
-        if self.boundary_hit is not None:
-            self.end_point = self.find_intersection_point(self.shortest_path)
-            self.hit_block = self.room_map.block_enclosed(self.end_point, self.direction)
+        self.find_end()
 
     def collision(self):
         """Finds the boundary that is in the ray's path"""
-        shortest_path = np.inf
-        boundary_hit = None
-        
-        for boundary in self.room_map.boundaries:
-            distance = boundary.boundary_intersection(self)
-            if distance is not None:
-                if distance <= 0.01:
-                    continue
-            else:
-                continue
-            if  distance < shortest_path:
-                shortest_path = distance
-                boundary_hit = boundary
-        return boundary_hit, shortest_path
+        return self.room_map.nearest_boundary(self.start_point, self.direction)
     
     def new_trajectory(self, new_direction):
         self.change_direction(np.array(new_direction))
-        self.boundary_hit, self.shortest_path = self.collision()
-        self.end_point = self.start_point + 10000 * self.unit_direction
-        self.hit_block = None
-        if self.boundary_hit is not None:
-            self.end_point = self.find_intersection_point(self.shortest_path)
-            self.hit_block = self.room_map.block_enclosed(self.end_point, self.direction)
+        self.find_end()
+
+    def refraction_indices(self):
+        """Refraction index before and after the boundary hit, free space is 1"""
+        refraction_i = 1 if self.medium is None else self.medium.refraction_index
+        refraction_r = 1 if self.hit_block is None else self.hit_block.refraction_index
+        return refraction_i, refraction_r
+
+    def reflectance(self):
+        """
+        Fraction of end_power reflected by the boundary hit, the rest is transmitted.
+        Uses the boundary's reflectivity when it has one, otherwise the Fresnel equations.
+        Total internal reflection reflects everything either way
+        """
+        reflectivity = self.boundary_hit.reflectivity
+        refraction_i, refraction_r = self.refraction_indices()
+        if reflectivity is not None:
+            dx, dy = self.unit_direction.tolist()
+            nx, ny = self.boundary_hit.unit_normal.tolist()
+            if refract(dx, dy, nx, ny, refraction_i, refraction_r) is None:
+                return 1
+            return reflectivity
+        cos_i = float(np.dot(self.unit_direction, self.boundary_hit.unit_normal))
+        return fresnel_reflectance(cos_i, refraction_i, refraction_r)
 
     def reflect(self):
         if self.boundary_hit is None:
             return None
-        reflect_direction = self.reflect_ray(self.boundary_hit)
-        return Ray(reflect_direction, self.power, self.end_point, self.room_map)
+        with profiler.stage("split"):
+            reflect_direction = self.reflect_ray(self.boundary_hit)
+            reflectance = self.reflectance()
+        profiler.count("reflections")
+        # A reflected ray stays on this side of the boundary
+        return Ray(reflect_direction, self.end_power * reflectance, self.end_point, self.room_map,
+                   self.travelled + self.path_length, self.medium)
             
     def refract(self):
         # No transmitted rays if it didn't hit anything
@@ -264,36 +406,16 @@ class Ray(Line):
         if self.boundary_hit.reflectivity == 1:
             return None
 
-        block_enclosed = self.room_map.block_enclosed(self.end_point, self.direction)
-        if block_enclosed is None:
-            refraction_r = 1
-        else:
-            refraction_r = block_enclosed.refraction_index
-
-        if self.medium is None:
-            refraction_i = 1
-        else:
-            refraction_i = self.medium.refraction_index
-
-        refraction_constant = refraction_i/refraction_r
-        incidence = self.unit_direction
-        normal = self.boundary_hit.unit_normal
-        dot_prod = np.dot(incidence, normal)
-        neg_power = 0
-        if dot_prod < 0:
-            neg_power = 1
-        if dot_prod >= 0:
-            neg_power = 2
-        i_perp = dot_prod * normal
-        i_par = incidence - i_perp
-
-        if np.linalg.norm(i_par) <= 1/refraction_constant:
-            t_par = refraction_constant * i_par
-            t_perp = (-1)**neg_power * np.sqrt(1 - (np.dot(t_par, t_par)))*normal
-            transmitted_direction = t_par + t_perp
-            return Ray(transmitted_direction, self.power, self.end_point, self.room_map)   
-        else:
-            return None
-        
-    def draw_ray(self, surface):
-        pygame.draw.line(surface, (255,255,0), self.start_point, self.end_point)
\ No newline at end of file
+        with profiler.stage("split"):
+            refraction_i, refraction_r = self.refraction_indices()
+            dx, dy = self.unit_direction.tolist()
+            nx, ny = self.boundary_hit.unit_normal.tolist()
+            transmitted_direction = refract(dx, dy, nx, ny, refraction_i, refraction_r)
+            if transmitted_direction is None:
+                # Total internal reflection
+                profiler.count("total_internal_reflections")
+                return None
+            transmitted_power = self.end_power * (1 - self.reflectance())
+        profiler.count("refractions")
+        return Ray(np.array(transmitted_direction), transmitted_power, self.end_point, self.room_map,
+                   self.travelled + self.path_length, self.hit_block)
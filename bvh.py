@@ -0,0 +1,167 @@
+from math import inf
+import numpy as np
+import profiler
+from intersect import MIN_PARAM, LineSearch, line_hit
+
+BOX_PADDING = 1e-7
+
+
+def ray_box_range(sx, sy, inv_dx, inv_dy, box):
+    """Slab test on scalars. Returns the n param range (near, far) where the line is inside the box"""
+    min_x, min_y, max_x, max_y = box
+    if inv_dx == inf or inv_dx == -inf:
+        if sx < min_x or sx > max_x:
+            return inf, -inf
+        near_x, far_x = -inf, inf
+    else:
+        near_x, far_x = (min_x - sx) * inv_dx, (max_x - sx) * inv_dx
+        if near_x > far_x:
+            near_x, far_x = far_x, near_x
+    if inv_dy == inf or inv_dy == -inf:
+        if sy < min_y or sy > max_y:
+            return inf, -inf
+        near_y, far_y = -inf, inf
+    else:
+        near_y, far_y = (min_y - sy) * inv_dy, (max_y - sy) * inv_dy
+        if near_y > far_y:
+            near_y, far_y = far_y, near_y
+    return max(near_x, near_y), min(far_x, far_y)
+
+
+def inverse(value):
+    if value == 0:
+        return inf
+    return 1 / value
+
+
+class BVH(LineSearch):
+    """
+    Axis aligned bounding box tree over the edges of a Map.
+    Nodes are stored in flat arrays, node 0 is the root.
+    A leaf has left == -1 and owns order[first:first + count]
+    """
+    def __init__(self, edge_starts, edge_directions, leaf_size=4):
+        self.edge_starts = edge_starts
+        self.edge_directions = edge_directions
+        self.leaf_size = leaf_size
+        edge_ends = edge_starts + edge_directions
+        # Pad the boxes slightly so hits right on a box face aren't lost to rounding
+        self.edge_min = np.minimum(edge_starts, edge_ends) - BOX_PADDING
+        self.edge_max = np.maximum(edge_starts, edge_ends) + BOX_PADDING
+        self.order = np.arange(len(edge_starts))
+
+        box_min, box_max, left, right, first, count = [], [], [], [], [], []
+        # Build iteratively so deep trees don't hit the recursion limit
+        stack = [(0, len(edge_starts), -1, 0)]
+        while stack:
+            lo, hi, parent, side = stack.pop()
+            node = len(left)
+            if parent >= 0:
+                if side == 0:
+                    left[parent] = node
+                else:
+                    right[parent] = node
+            members = self.order[lo:hi]
+            if hi > lo:
+                box_min.append(self.edge_min[members].min(axis=0))
+                box_max.append(self.edge_max[members].max(axis=0))
+            else:
+                box_min.append(np.full(2, np.inf))
+                box_max.append(np.full(2, -np.inf))
+            left.append(-1)
+            right.append(-1)
+            first.append(lo)
+            count.append(hi - lo)
+            if hi - lo <= leaf_size:
+                continue
+            # Split on the median centroid along the longest axis
+            centres = (self.edge_min[members] + self.edge_max[members]) / 2
+            axis = int(np.argmax(centres.max(axis=0) - centres.min(axis=0)))
+            self.order[lo:hi] = members[np.argsort(centres[:, axis], kind="stable")]
+            mid = (lo + hi) // 2
+            stack.append((mid, hi, node, 1))
+            stack.append((lo, mid, node, 0))
+
+        self.box_min = np.array(box_min).reshape(-1, 2)
+        self.box_max = np.array(box_max).reshape(-1, 2)
+        self.left = np.array(left, dtype=int)
+        self.right = np.array(right, dtype=int)
+        self.first = np.array(first, dtype=int)
+        self.count = np.array(count, dtype=int)
+        self._make_lists()
+
+    # What arrays() saves, enough to rebuild the tree without sorting the edges again
+    array_fields = ("order", "box_min", "box_max", "left", "right", "first", "count")
+
+    def arrays(self):
+        """The built tree as a dict of arrays, see from_arrays"""
+        arrays = {name: getattr(self, name) for name in self.array_fields}
+        arrays["leaf_size"] = np.array(self.leaf_size)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, edge_starts, edge_directions, arrays):
+        """A BVH over the same edges as the one arrays() was called on, without building it again"""
+        bvh = cls.__new__(cls)
+        bvh.edge_starts = edge_starts
+        bvh.edge_directions = edge_directions
+        bvh.leaf_size = int(arrays["leaf_size"])
+        edge_ends = edge_starts + edge_directions
+        bvh.edge_min = np.minimum(edge_starts, edge_ends) - BOX_PADDING
+        bvh.edge_max = np.maximum(edge_starts, edge_ends) + BOX_PADDING
+        for name in cls.array_fields:
+            setattr(bvh, name, np.asarray(arrays[name]))
+        bvh._make_lists()
+        return bvh
+
+    def _make_lists(self):
+        edge_starts, edge_directions = self.edge_starts, self.edge_directions
+        # Python lists are much faster than numpy for the per node scalar work below
+        self._boxes = np.hstack([self.box_min, self.box_max]).tolist()
+        self._children = np.stack([self.left, self.right], axis=1).tolist()
+        self._leaves = [self.order[f:f + c].tolist() for f, c in zip(self.first, self.count)]
+        self._edges = np.hstack([edge_starts, edge_directions]).tolist()
+
+    def _walk(self, start_point, direction, min_param):
+        """
+        Walks the boxes front to back, skipping boxes behind the best hit so far.
+        Yields (edge, t) for the edges crossed in front of min_param
+        """
+        sx, sy = float(start_point[0]), float(start_point[1])
+        dx, dy = float(direction[0]), float(direction[1])
+        inv_dx, inv_dy = inverse(dx), inverse(dy)
+        boxes, children, leaves, edges = self._boxes, self._children, self._leaves, self._edges
+        best = inf
+        t_near, t_far = ray_box_range(sx, sy, inv_dx, inv_dy, boxes[0])
+        stack = [(t_near, 0)]
+        while stack:
+            t_near, node = stack.pop()
+            if t_near > best:
+                continue
+            left, right = children[node]
+            if left < 0:
+                profiler.count("intersection_tests", len(leaves[node]))
+                for edge in leaves[node]:
+                    t = line_hit(sx, sy, dx, dy, *edges[edge], min_param)
+                    if t is not None:
+                        if t < best:
+                            best = t
+                        yield edge, t
+                continue
+            visit = []
+            for child in (left, right):
+                t_near, t_far = ray_box_range(sx, sy, inv_dx, inv_dy, boxes[child])
+                if t_near <= t_far and t_far > min_param:
+                    visit.append((t_near, child))
+            # Push the far child first so the near one is popped first
+            visit.sort(reverse=True)
+            stack += visit
+
+    def nearest(self, start_point, direction, min_param=MIN_PARAM):
+        """Same contract as intersect.nearest_hit but only visits boxes the line passes through"""
+        best_edge, best_param = -1, inf
+        for edge, param in self._walk(start_point, direction, min_param):
+            # Keep the first edge in Map order on ties
+            if param < best_param or (param == best_param and edge < best_edge):
+                best_edge, best_param = edge, param
+        return best_edge, best_param
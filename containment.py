@@ -0,0 +1,198 @@
+import numpy as np
+import profiler
+from intersect import MIN_PARAM, batch_edge_params, row_edge_params, line_hit, valid_hits
+
+# Points this close outside a block's bounding box still get the full test, hit points carry rounding error
+BOX_TOLERANCE = 1e-6
+
+
+def box_pairs(min_a, max_a, min_b, max_b, max_pairs=1 << 22):
+    """
+    Every (i, j) where box i of a overlaps box j of b, boxes given as (N, 2) corner arrays.
+    Sweeping over the boxes sorted on x only looks at pairs whose x ranges overlap
+    instead of testing every box of a against every box of b
+    """
+    rows_a, rows_b = _sweep(min_a, max_a, min_b, max_b, "left", max_pairs)
+    # Boxes of a starting inside a box of b, equal starts were already found above
+    other_b, other_a = _sweep(min_b, max_b, min_a, max_a, "right", max_pairs)
+    return np.concatenate([rows_a, other_a]), np.concatenate([rows_b, other_b])
+
+
+def _sweep(min_a, max_a, min_b, max_b, side, max_pairs):
+    """Overlapping pairs where box j of b starts in the x range of box i of a, max_pairs candidates at a time"""
+    order = np.argsort(min_b[:, 0], kind="stable")
+    starts = min_b[order, 0]
+    lo = np.searchsorted(starts, min_a[:, 0], side)
+    counts = np.maximum(np.searchsorted(starts, max_a[:, 0], "right") - lo, 0)
+    totals = np.cumsum(counts)
+    rows_a, rows_b = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+    first = 0
+    while first < len(counts):
+        done = totals[first - 1] if first else 0
+        last = max(int(np.searchsorted(totals, done + max_pairs, "right")), first + 1)
+        chunk = counts[first:last]
+        a = np.repeat(np.arange(first, last), chunk)
+        steps = np.arange(len(a)) - np.repeat(np.cumsum(chunk) - chunk, chunk)
+        b = order[np.repeat(lo[first:last], chunk) + steps]
+        keep = (min_a[a, 1] <= max_b[b, 1]) & (max_a[a, 1] >= min_b[b, 1])
+        rows_a.append(a[keep])
+        rows_b.append(b[keep])
+        first = last
+    return np.concatenate(rows_a), np.concatenate(rows_b)
+
+
+class ContainmentIndex:
+    """
+    Answers which block encloses a point, using the same crossing number test as Block.enclosed_point:
+    a line from the point along direction crosses the block's edges an odd number of times.
+    Blocks whose bounding box doesn't hold the point are rejected before any edge is tested.
+    As in Map.block_enclosed the first enclosing block wins when blocks overlap
+    """
+    def __init__(self, blocks, edge_starts, edge_directions, edge_blocks):
+        self.edge_starts = edge_starts
+        self.edge_directions = edge_directions
+        self.edge_blocks = edge_blocks
+        num_blocks = len(blocks)
+        self.offsets = np.searchsorted(edge_blocks, np.arange(num_blocks + 1))
+        self.box_min = np.full((num_blocks, 2), np.inf)
+        self.box_max = np.full((num_blocks, 2), -np.inf)
+        # +1 for counter clockwise blocks, -1 for clockwise, 0 for blocks with no area
+        self.orientation = np.zeros(num_blocks)
+        for i, block in enumerate(blocks):
+            if len(block.vertices) == 0:
+                continue
+            self.box_min[i] = block.box_min - BOX_TOLERANCE
+            self.box_max[i] = block.box_max + BOX_TOLERANCE
+            self.orientation[i] = np.sign(block.signed_area)
+        # Outward normal of every edge, so the side a ray crosses an edge from is known without a test
+        owner_orientation = self.orientation[edge_blocks] if len(edge_blocks) else np.zeros(0)
+        self.edge_outward = np.stack([edge_directions[:, 1], -edge_directions[:, 0]], axis=1) * owner_orientation[:, None]
+        self._edges = np.hstack([edge_starts, edge_directions]).reshape(-1, 4).tolist()
+
+    def _candidates(self, points):
+        """(N, B) mask of the blocks whose bounding box holds each point"""
+        points = points[:, None, :]
+        return np.all((points >= self.box_min[None]) & (points <= self.box_max[None]), axis=2)
+
+    def _crossings(self, block, px, py, dx, dy, min_param):
+        """Crossing count of one line against one block's edges in plain floats"""
+        counter = 0
+        profiler.count("intersection_tests", self.offsets[block + 1] - self.offsets[block])
+        for edge in range(self.offsets[block], self.offsets[block + 1]):
+            if line_hit(px, py, dx, dy, *self._edges[edge], min_param) is not None:
+                counter += 1
+        return counter
+
+    def block_index(self, point, direction, min_param=MIN_PARAM):
+        """Index of the first block enclosing point, -1 for none"""
+        profiler.count("containment_queries")
+        px, py = float(point[0]), float(point[1])
+        dx, dy = float(direction[0]), float(direction[1])
+        for block in np.flatnonzero(self._candidates(np.array([[px, py]]))[0]):
+            if self._crossings(block, px, py, dx, dy, min_param) % 2 == 1:
+                return int(block)
+        return -1
+
+    def far_side(self, edge, point, direction, min_param=MIN_PARAM):
+        """
+        Index of the block on the far side of edge for a ray crossing it at point, -1 for none.
+        Whether the ray enters or leaves the edge's own block comes from the edge's outward normal,
+        only other blocks whose bounding box holds the point need a crossing test
+        """
+        profiler.count("containment_queries")
+        px, py = float(point[0]), float(point[1])
+        dx, dy = float(direction[0]), float(direction[1])
+        owner = self.edge_blocks[edge]
+        for block in np.flatnonzero(self._candidates(np.array([[px, py]]))[0]):
+            if block == owner and self.orientation[owner] != 0:
+                outward_x, outward_y = self.edge_outward[edge]
+                if dx * outward_x + dy * outward_y < 0:
+                    return int(block)
+                continue
+            if self._crossings(block, px, py, dx, dy, min_param) % 2 == 1:
+                return int(block)
+        return -1
+
+    def blocks_index(self, points, directions, edges=None, min_param=MIN_PARAM):
+        """
+        block_index for N points at once, or far_side when the (N,) edges that were hit are given
+        (-1 rows fall back to block_index). Returns an (N,) array, -1 for none
+        """
+        num_rows = len(points)
+        profiler.count("containment_queries", num_rows)
+        result = np.full(num_rows, -1)
+        if num_rows == 0:
+            return result
+        # Only the (row, block) pairs whose bounding boxes overlap, grouped by block in Map order
+        rows_of, blocks_of = box_pairs(points, points, self.box_min, self.box_max)
+        order = np.lexsort((rows_of, blocks_of))
+        blocks, firsts = np.unique(blocks_of[order], return_index=True)
+        unresolved = np.ones(num_rows, dtype=bool)
+        owners = np.full(num_rows, -1)
+        entering = np.zeros(num_rows, dtype=bool)
+        if edges is not None:
+            hit = edges >= 0
+            owners[hit] = self.edge_blocks[edges[hit]]
+            entering[hit] = np.einsum("ij,ij->i", directions[hit], self.edge_outward[edges[hit]]) < 0
+        for block, rows in zip(blocks.tolist(), np.split(rows_of[order], firsts[1:])):
+            rows = rows[unresolved[rows]]
+            if len(rows) == 0:
+                continue
+            inside = np.zeros(len(rows), dtype=bool)
+            owned = owners[rows] == block
+            if self.orientation[block] != 0:
+                inside[owned] = entering[rows[owned]]
+            else:
+                owned[:] = False
+            tested = rows[~owned]
+            if len(tested):
+                lo, hi = self.offsets[block], self.offsets[block + 1]
+                t, u = batch_edge_params(points[tested], directions[tested],
+                                         self.edge_starts[lo:hi], self.edge_directions[lo:hi])
+                crossed = valid_hits(t, u, min_param)
+                inside[~owned] = crossed.sum(axis=1) % 2 == 1
+            result[rows[inside]] = block
+            unresolved[rows[inside]] = False
+        return result
+
+
+def touching_edges(edge_starts, edge_directions, edge_blocks, max_pairs=1 << 22):
+    """
+    Flags every edge that touches or crosses an edge of another block.
+    Along an edge that touches nothing, the blocks on either side can't change
+    """
+    num_edges = len(edge_starts)
+    touching = np.zeros(num_edges, dtype=bool)
+    if num_edges == 0:
+        return touching
+    edge_ends = edge_starts + edge_directions
+    box_min = np.minimum(edge_starts, edge_ends) - BOX_TOLERANCE
+    box_max = np.maximum(edge_starts, edge_ends) + BOX_TOLERANCE
+    rows, others = box_pairs(box_min, box_max, box_min, box_max, max_pairs)
+    different = edge_blocks[rows] != edge_blocks[others]
+    rows, others = rows[different], others[different]
+    if len(rows) == 0:
+        return touching
+    t, u = row_edge_params(edge_starts[rows], edge_directions[rows], edge_starts[others], edge_directions[others])
+    # Parallel pairs whose boxes overlap may be collinear and overlapping, treat them as touching
+    meet = np.isnan(t) | ((t >= -BOX_TOLERANCE) & (t <= 1 + BOX_TOLERANCE)
+                          & (u >= -BOX_TOLERANCE) & (u <= 1 + BOX_TOLERANCE))
+    touching[rows[meet]] = True
+    return touching
+
+
+def edge_media(index: ContainmentIndex, edge_normals):
+    """
+    The block on each side of every edge, (E, 2) with column 0 the side the unit normal points to
+    and column 1 the other side, -1 for free space. Found at the edge midpoint with the usual
+    first block wins rule. Only valid along the whole edge where touching_edges is False
+    """
+    num_edges = len(index.edge_starts)
+    media = np.full((num_edges, 2), -1)
+    if num_edges == 0:
+        return media
+    edges = np.arange(num_edges)
+    midpoints = index.edge_starts + index.edge_directions / 2
+    media[:, 0] = index.blocks_index(midpoints, edge_normals, edges)
+    media[:, 1] = index.blocks_index(midpoints, -edge_normals, edges)
+    return media
@@ -0,0 +1,103 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from block import Map
+from packet import trace_packet
+from tracer import fan_directions
+from link_budget import LinkBudget
+from result_store import SegmentWriter
+
+# Set once in each worker process by _init_worker so the scene is only shipped once
+_worker_map = None
+_worker_settings = None
+_worker_store = None
+
+
+def grid_positions(room_map: Map, resolution):
+    """x and y coordinates of a grid covering every boundary in the map, one point per cell centre"""
+    ends = room_map.edge_starts + room_map.edge_directions
+    low = np.minimum(room_map.edge_starts, ends).min(axis=0)
+    high = np.maximum(room_map.edge_starts, ends).max(axis=0)
+    xs = np.arange(low[0] + resolution / 2, high[0], resolution)
+    ys = np.arange(low[1] + resolution / 2, high[1], resolution)
+    return xs, ys
+
+
+def trace_positions(room_map: Map, positions, directions, iterations=3, power_threshold=0, writer=None,
+                    first_position=0):
+    """
+    Power received by each receiver from a fan fired at each position. Returns (P, R).
+    With a result_store.SegmentWriter every segment is also written out, the source of a segment
+    is position * number of rays + ray where position counts from first_position
+    """
+    budget = LinkBudget(room_map)
+    received = np.zeros((len(positions), len(budget.receivers)))
+    for i, position in enumerate(positions):
+        origins = np.broadcast_to(position, directions.shape)
+        segments = trace_packet(room_map, origins, directions, iterations=iterations,
+                                power_threshold=power_threshold)
+        budget.reset()
+        budget.record_segments(segments)
+        received[i] = budget.power
+        if writer is not None:
+            writer.write(segments, (first_position + i) * len(directions))
+    return received
+
+
+def _trace_tile_into(room_map, tile, positions, store, settings):
+    """trace_positions for one tile, writing its segments into store under the tile's own prefix"""
+    if store is None:
+        return trace_positions(room_map, positions, **settings)
+    with SegmentWriter(store, prefix=f"tile{tile[0]:012d}") as writer:
+        return trace_positions(room_map, positions, **settings, writer=writer, first_position=tile[0])
+
+
+def _init_worker(room_map, settings, store):
+    global _worker_map, _worker_settings, _worker_store
+    _worker_map = room_map
+    _worker_settings = settings
+    _worker_store = store
+
+
+def _trace_tile(tile, positions):
+    return tile, _trace_tile_into(_worker_map, tile, positions, _worker_store, _worker_settings)
+
+
+def coverage_map(room_map: Map, xs, ys, number_of_rays=360, iterations=3, power_threshold=0,
+                 workers=None, tile_size=256, out=None, store=None):
+    """
+    Fires a fan of number_of_rays from every grid position (x, y) and records the power each Receiver gets.
+    Returns an array of shape (len(ys), len(xs), number of receivers).
+    The grid is cut into tiles of tile_size positions which are traced on a process pool,
+    results are written into out (e.g. a np.memmap) as tiles finish.
+    Every segment is written to the result_store folder store when one is given, each tile writes its own
+    chunks so a segment's source is grid position (row major) * number_of_rays + ray.
+    workers=1 traces in this process
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    num_receivers = len(room_map.receivers)
+    if out is None:
+        out = np.zeros((len(ys), len(xs), num_receivers))
+    # Nothing to record, unless the segments are wanted
+    if num_receivers == 0 and store is None:
+        return out
+    # reshape(-1, 0) can't work out the rows
+    flat = out.reshape(len(ys) * len(xs), num_receivers)
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    positions = np.stack([grid_x.ravel(), grid_y.ravel()], axis=1)
+    tiles = [(lo, min(lo + tile_size, len(positions))) for lo in range(0, len(positions), tile_size)]
+    settings = {"directions": fan_directions(number_of_rays), "iterations": iterations,
+                "power_threshold": power_threshold}
+
+    if workers == 1:
+        for lo, hi in tiles:
+            flat[lo:hi] = _trace_tile_into(room_map, (lo, hi), positions[lo:hi], store, settings)
+        return out
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(room_map, settings, store)) as executor:
+        futures = [executor.submit(_trace_tile, tile, positions[tile[0]:tile[1]]) for tile in tiles]
+        for future in as_completed(futures):
+            (lo, hi), received = future.result()
+            flat[lo:hi] = received
+    return out
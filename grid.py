@@ -0,0 +1,157 @@
+from math import inf, floor, sqrt, ceil
+import numpy as np
+import profiler
+from intersect import MIN_PARAM, LineSearch, line_hit
+from bvh import BOX_PADDING, ray_box_range, inverse
+
+
+class UniformGrid(LineSearch):
+    """
+    Buckets the edges of a Map into square cells.
+    Rays march through the cells in order (Amanatides-Woo DDA) and stop at the first cell
+    that holds a confirmed hit, which suits dense axis aligned layouts.
+    Cell i, j is cell_edges[cell_start[k]:cell_start[k + 1]] where k = j * nx + i
+    """
+    def __init__(self, edge_starts, edge_directions, cell_size=None):
+        self.edge_starts = edge_starts
+        self.edge_directions = edge_directions
+        edge_ends = edge_starts + edge_directions
+        edge_min = np.minimum(edge_starts, edge_ends) - BOX_PADDING
+        edge_max = np.maximum(edge_starts, edge_ends) + BOX_PADDING
+        num_edges = len(edge_starts)
+        if num_edges == 0:
+            self.origin = np.zeros(2)
+            self.extent = np.zeros(2)
+        else:
+            self.origin = edge_min.min(axis=0)
+            self.extent = edge_max.max(axis=0) - self.origin
+        if cell_size is None:
+            # Aim for about two cells per edge
+            area = max(self.extent[0] * self.extent[1], 1e-12)
+            cell_size = sqrt(area / max(2 * num_edges, 1))
+            cell_size = max(cell_size, max(self.extent) / 4096, 1e-6)
+        self.cell_size = float(cell_size)
+        self.nx = max(int(ceil(self.extent[0] / self.cell_size)), 1)
+        self.ny = max(int(ceil(self.extent[1] / self.cell_size)), 1)
+
+        cells, members = [], []
+        for edge in range(num_edges):
+            cell = self._edge_cells(edge_starts[edge], edge_directions[edge], edge_min[edge], edge_max[edge])
+            cells.append(cell)
+            members.append(np.full(len(cell), edge))
+        cells = np.concatenate(cells) if cells else np.zeros(0, dtype=int)
+        members = np.concatenate(members) if members else np.zeros(0, dtype=int)
+        # Stable sort keeps each cell's edges in Map order
+        order = np.argsort(cells, kind="stable")
+        self.cell_edges = members[order]
+        self.cell_start = np.searchsorted(cells[order], np.arange(self.nx * self.ny + 1))
+        self._make_lists()
+
+    def arrays(self):
+        """The filled grid as a dict of arrays, see from_arrays"""
+        return {"origin": self.origin, "extent": self.extent, "shape": np.array([self.nx, self.ny]),
+                "cell_size": np.array(self.cell_size), "cell_edges": self.cell_edges, "cell_start": self.cell_start}
+
+    @classmethod
+    def from_arrays(cls, edge_starts, edge_directions, arrays):
+        """A grid over the same edges as the one arrays() was called on, without bucketing them again"""
+        grid = cls.__new__(cls)
+        grid.edge_starts = edge_starts
+        grid.edge_directions = edge_directions
+        grid.origin = np.asarray(arrays["origin"])
+        grid.extent = np.asarray(arrays["extent"])
+        grid.nx, grid.ny = (int(n) for n in arrays["shape"])
+        grid.cell_size = float(arrays["cell_size"])
+        grid.cell_edges = np.asarray(arrays["cell_edges"])
+        grid.cell_start = np.asarray(arrays["cell_start"])
+        grid._make_lists()
+        return grid
+
+    def _make_lists(self):
+        # Python lists are much faster than numpy for the per cell scalar work
+        self._cells = [self.cell_edges[a:b].tolist() for a, b in zip(self.cell_start[:-1], self.cell_start[1:])]
+        self._edges = np.hstack([self.edge_starts, self.edge_directions]).reshape(-1, 4).tolist()
+
+    def _edge_cells(self, start, direction, edge_min, edge_max):
+        """Cells whose (padded) box the edge passes through"""
+        h = self.cell_size
+        i0, j0 = np.clip(((edge_min - self.origin) // h).astype(int), 0, [self.nx - 1, self.ny - 1])
+        i1, j1 = np.clip(((edge_max - self.origin) // h).astype(int), 0, [self.nx - 1, self.ny - 1])
+        ii, jj = np.meshgrid(np.arange(i0, i1 + 1), np.arange(j0, j1 + 1))
+        ii, jj = ii.ravel(), jj.ravel()
+        box_min = self.origin + np.stack([ii, jj], axis=1) * h - BOX_PADDING
+        box_max = box_min + h + 2 * BOX_PADDING
+        # Slab test of the segment (n param 0 to 1) against every candidate cell
+        t_near = np.zeros(len(ii))
+        t_far = np.ones(len(ii))
+        for axis in range(2):
+            if direction[axis] == 0:
+                outside = (start[axis] < box_min[:, axis]) | (start[axis] > box_max[:, axis])
+                t_far[outside] = -1
+                continue
+            t1 = (box_min[:, axis] - start[axis]) / direction[axis]
+            t2 = (box_max[:, axis] - start[axis]) / direction[axis]
+            t_near = np.maximum(t_near, np.minimum(t1, t2))
+            t_far = np.minimum(t_far, np.maximum(t1, t2))
+        keep = t_near <= t_far
+        return jj[keep] * self.nx + ii[keep]
+
+    def _march(self, sx, sy, dx, dy):
+        """Yields (cell, t_enter, t_exit) for the cells along the line, nearest first"""
+        h, nx, ny = self.cell_size, self.nx, self.ny
+        x0, y0 = float(self.origin[0]), float(self.origin[1])
+        box = (x0, y0, x0 + nx * h, y0 + ny * h)
+        inv_dx, inv_dy = inverse(dx), inverse(dy)
+        t_near, t_far = ray_box_range(sx, sy, inv_dx, inv_dy, box)
+        t = max(t_near, 0.0)
+        if t > t_far:
+            return
+        i = min(max(int(floor((sx + t * dx - x0) / h)), 0), nx - 1)
+        j = min(max(int(floor((sy + t * dy - y0) / h)), 0), ny - 1)
+        if dx > 0:
+            step_i, t_max_x, t_delta_x = 1, (x0 + (i + 1) * h - sx) * inv_dx, h * inv_dx
+        elif dx < 0:
+            step_i, t_max_x, t_delta_x = -1, (x0 + i * h - sx) * inv_dx, -h * inv_dx
+        else:
+            step_i, t_max_x, t_delta_x = 0, inf, inf
+        if dy > 0:
+            step_j, t_max_y, t_delta_y = 1, (y0 + (j + 1) * h - sy) * inv_dy, h * inv_dy
+        elif dy < 0:
+            step_j, t_max_y, t_delta_y = -1, (y0 + j * h - sy) * inv_dy, -h * inv_dy
+        else:
+            step_j, t_max_y, t_delta_y = 0, inf, inf
+        while 0 <= i < nx and 0 <= j < ny:
+            t_exit = min(t_max_x, t_max_y, t_far)
+            yield j * nx + i, t, t_exit
+            if t_exit >= t_far:
+                return
+            t = t_exit
+            if t_max_x < t_max_y:
+                i += step_i
+                t_max_x += t_delta_x
+            else:
+                j += step_j
+                t_max_y += t_delta_y
+
+    def _cell_hits(self, cell, sx, sy, dx, dy, min_param):
+        profiler.count("intersection_tests", len(self._cells[cell]))
+        for edge in self._cells[cell]:
+            t = line_hit(sx, sy, dx, dy, *self._edges[edge], min_param)
+            if t is not None:
+                yield edge, t
+
+    def nearest(self, start_point, direction, min_param=MIN_PARAM):
+        """Same contract as intersect.nearest_hit"""
+        sx, sy = float(start_point[0]), float(start_point[1])
+        dx, dy = float(direction[0]), float(direction[1])
+        best_edge, best_param = -1, inf
+        for cell, t_enter, t_exit in self._march(sx, sy, dx, dy):
+            for edge, param in self._cell_hits(cell, sx, sy, dx, dy, min_param):
+                # Keep the first edge in Map order on ties
+                if param < best_param or (param == best_param and edge < best_edge):
+                    best_edge, best_param = edge, param
+            # A hit inside this cell can't be beaten by a later cell.
+            # Hits exactly on the exit face may tie with edges in the next cell, so look once more
+            if best_param < t_exit:
+                break
+        return best_edge, best_param
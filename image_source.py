@@ -0,0 +1,200 @@
+"""
+Exact specular paths from a transmitter to the receivers by the image source method.
+The transmitter is mirrored across every boundary, each image again across every other boundary
+and so on up to max_bounces. The straight line from an image to a receiver unfolds into a reflection path,
+which is kept only when every leg really hits the boundary it should first, using the same
+nearest hit search and reflectance as the packet tracer. Refracted paths are not found, use a ray fan for those
+"""
+import numpy as np
+from block import Map
+from link_budget import LinkBudget
+from optics import absorb
+from intersect import row_edge_params
+from packet import split_at_boundary, block_values
+
+# Relative tolerance on where a leg is expected to end
+LENGTH_TOLERANCE = 1e-6
+
+
+def mirror_points(points, edge_starts, edge_normals):
+    """points (N, 2) mirrored across the lines of N boundaries with unit normals"""
+    offsets = np.einsum("ij,ij->i", points - edge_starts, edge_normals)
+    return points - 2 * offsets[:, None] * edge_normals
+
+
+class ImageSourceSolver:
+    """
+    Finds every specular path with up to max_bounces reflections from a transmitter to the centre
+    (vertex mean) of each receiver in room_map. A path reaches a receiver where it first crosses
+    one of its edges from outside, that is where its power and length are taken, like LinkBudget does.
+    Results are cached for the last cache_size transmitter positions
+    """
+    def __init__(self, room_map: Map, max_bounces=2, power=1, cache_size=64):
+        self.room_map = room_map
+        self.max_bounces = max_bounces
+        self.power = power
+        self.cache_size = cache_size
+        self.receiver_blocks = np.array([room_map.block_indices[id(receiver)] for receiver in room_map.receivers],
+                                        dtype=int)
+        self.targets = np.array([np.mean(receiver.vertices, axis=0) for receiver in room_map.receivers],
+                                dtype=float).reshape(-1, 2)
+        # points holds the transmitter, each reflection point and the receiver crossing, padded with nan
+        self.path_dtype = np.dtype([("receiver", int), ("bounces", int), ("power", float), ("path_length", float),
+                                    ("edges", int, (max_bounces,)), ("points", float, (max_bounces + 2, 2))])
+        self._cache = {}
+
+    def __repr__(self):
+        return f"ImageSourceSolver({len(self.receiver_blocks)} receivers, {self.max_bounces} bounces)"
+
+    def images(self, origin):
+        """
+        The image tree of a transmitter, one (edges, parents, images) level per bounce.
+        Level k has the images reflected k times, edges is the boundary each was last mirrored across and
+        parents the image it was mirrored from in level k - 1. Boundaries that can't be reached from the
+        previous one, because they lie wholly behind it, are left out
+        """
+        room_map = self.room_map
+        num_edges = len(room_map.boundaries)
+        levels = [(np.full(1, -1), np.full(1, -1), np.asarray(origin, dtype=float).reshape(1, 2))]
+        for _ in range(self.max_bounces):
+            last_edges, _, last_images = levels[-1]
+            parents = np.repeat(np.arange(len(last_images)), num_edges)
+            edges = np.tile(np.arange(num_edges), len(last_images))
+            images = last_images[parents]
+            starts = room_map.edge_starts[edges]
+            normals = room_map.edge_normals[edges]
+            # An image on a boundary's line mirrors onto itself
+            keep = np.abs(np.einsum("ij,ij->i", images - starts, normals)) > 1e-9
+            previous = last_edges[parents]
+            reflected = previous >= 0
+            if np.any(reflected):
+                # The beam leaving the previous boundary is on the other side of it from the image
+                prev_starts = room_map.edge_starts[previous[reflected]]
+                prev_normals = room_map.edge_normals[previous[reflected]]
+                image_side = np.einsum("ij,ij->i", images[reflected] - prev_starts, prev_normals)
+                side_0 = np.einsum("ij,ij->i", starts[reflected] - prev_starts, prev_normals)
+                side_1 = np.einsum("ij,ij->i", starts[reflected] + room_map.edge_directions[edges[reflected]]
+                                   - prev_starts, prev_normals)
+                keep[reflected] &= (edges[reflected] != previous[reflected]) & (
+                    (image_side * side_0 < -1e-9) | (image_side * side_1 < -1e-9))
+            edges, parents = edges[keep], parents[keep]
+            levels.append((edges, parents, mirror_points(images[keep], starts[keep], normals[keep])))
+        return levels
+
+    def _entry(self, origin):
+        """The cache entry of a transmitter position, {"paths": ...} and "budget" once link_budget asked for it"""
+        key = tuple(np.asarray(origin, dtype=float).ravel().tolist())
+        if key in self._cache:
+            return self._cache[key]
+        origin = np.asarray(origin, dtype=float).reshape(2)
+        levels = self.images(origin)
+        found = [self._solve(origin, levels, bounces) for bounces in range(self.max_bounces + 1)]
+        paths = np.concatenate(found)
+        paths = paths[np.lexsort((paths["path_length"], paths["receiver"]))]
+        # Callers share the cached array
+        paths.setflags(write=False)
+        if len(self._cache) >= self.cache_size:
+            self._cache.pop(next(iter(self._cache)))
+        self._cache[key] = {"paths": paths}
+        return self._cache[key]
+
+    def paths(self, origin):
+        """Every valid path from origin as a read only path_dtype array, sorted by receiver row then length"""
+        return self._entry(origin)["paths"]
+
+    def link_budget(self, origin) -> LinkBudget:
+        """
+        A LinkBudget holding the paths from origin, source is the row in paths(origin) and generation the bounces.
+        It is cached with the paths, so record into a fresh LinkBudget rather than this one
+        """
+        entry = self._entry(origin)
+        if "budget" in entry:
+            return entry["budget"]
+        paths = entry["paths"]
+        budget = LinkBudget(self.room_map)
+        incident = np.empty(len(paths), dtype=budget.path_dtype)
+        incident["receiver"] = paths["receiver"]
+        incident["source"] = np.arange(len(paths))
+        incident["generation"] = paths["bounces"]
+        incident["power"] = paths["power"]
+        incident["path_length"] = paths["path_length"]
+        budget.record_paths(incident)
+        entry["budget"] = budget
+        return budget
+
+    def _solve(self, origin, levels, bounces):
+        """Paths with exactly bounces reflections, one candidate per image of that level and receiver"""
+        room_map = self.room_map
+        num_images = len(levels[bounces][2])
+        receivers = np.tile(np.arange(len(self.targets)), num_images)
+        chain = np.repeat(np.arange(num_images), len(self.targets))
+
+        # Walk back from the receiver through the images to find the reflection points
+        edges = np.empty((len(chain), bounces), dtype=int)
+        points = np.empty((len(chain), bounces, 2))
+        towards = self.targets[receivers]
+        for level in range(bounces, 0, -1):
+            level_edges, parents, images = levels[level]
+            edge = level_edges[chain]
+            # Where the line from the image to the point it leads to crosses the image's boundary
+            starts = images[chain]
+            legs = towards - starts
+            t, u = row_edge_params(starts, legs, room_map.edge_starts[edge], room_map.edge_directions[edge])
+            crossing = starts + t[:, None] * legs
+            keep = (t > 0) & (t < 1) & (u >= 0) & (u <= 1)
+            chain, receivers, edges, points = parents[chain[keep]], receivers[keep], edges[keep], points[keep]
+            edges[:, level - 1] = edge[keep]
+            points[:, level - 1] = crossing[keep]
+            towards = crossing[keep]
+
+        # Then follow the path forwards checking every leg hits its boundary first
+        count = len(receivers)
+        start = np.tile(origin, (count, 1))
+        first = points[:, 0] if bounces else self.targets[receivers]
+        direction = first - start
+        direction = direction / np.linalg.norm(direction, axis=1)[:, None]
+        medium = room_map.blocks_enclosed(start, direction)
+        power = np.full(count, float(self.power))
+        travelled = np.zeros(count)
+        for leg in range(bounces):
+            ends = points[:, leg]
+            direction = ends - start
+            length = np.linalg.norm(direction, axis=1)
+            direction = direction / length[:, None]
+            edge, param = room_map.nearest_boundaries(start, direction)
+            keep = (edge == edges[:, leg]) & (np.abs(param - length) <= LENGTH_TOLERANCE * (1 + length))
+            start, direction, length, edge = start[keep], direction[keep], length[keep], edge[keep]
+            medium, power, travelled = medium[keep], power[keep], travelled[keep]
+            receivers, edges, points = receivers[keep], edges[keep], points[keep]
+            ends = points[:, leg]
+            end_power = absorb(power, block_values(room_map.absorption_coeffs, medium, 0.0), length)
+            hit_block = room_map.far_side_blocks(edge, ends, direction)
+            _, reflectance, _, _ = split_at_boundary(room_map, direction, medium, hit_block, edge)
+            # Reflected rays stay in their medium
+            power = end_power * reflectance
+            travelled = travelled + length
+            start = ends
+
+        direction = self.targets[receivers] - start
+        direction = direction / np.linalg.norm(direction, axis=1)[:, None]
+        edge, param = room_map.nearest_boundaries(start, direction)
+        block = self.receiver_blocks[receivers]
+        hit = np.flatnonzero(edge >= 0)
+        enters = np.zeros(len(edge), dtype=bool)
+        crossing = start + np.where(edge >= 0, param, 0)[:, None] * direction
+        enters[hit] = ((room_map.far_side_blocks(edge[hit], crossing[hit], direction[hit]) == block[hit])
+                       & (medium[hit] != block[hit]))
+
+        result = np.zeros(int(np.sum(enters)), dtype=self.path_dtype)
+        result["receiver"] = receivers[enters]
+        result["bounces"] = bounces
+        result["power"] = absorb(power[enters], block_values(room_map.absorption_coeffs, medium[enters], 0.0),
+                                 param[enters])
+        result["path_length"] = travelled[enters] + param[enters]
+        result["edges"] = -1
+        result["edges"][:, :bounces] = edges[enters]
+        result["points"] = np.nan
+        result["points"][:, 0] = origin
+        result["points"][:, 1:bounces + 1] = points[enters]
+        result["points"][:, bounces + 1] = crossing[enters]
+        return result
@@ -0,0 +1,169 @@
+import numpy as np
+import profiler
+
+# Rays ignore hits closer than this param so they don't re-hit the boundary they start on
+MIN_PARAM = 0.01
+
+
+def pack_edges(boundaries):
+    """
+    Packs boundaries into two (E, 2) arrays.
+    Row i holds the start point and direction of boundaries[i]
+    """
+    if len(boundaries) == 0:
+        return np.zeros((0, 2)), np.zeros((0, 2))
+    edge_starts = np.array([boundary.start_point for boundary in boundaries], dtype=float)
+    edge_directions = np.array([boundary.direction for boundary in boundaries], dtype=float)
+    return edge_starts, edge_directions
+
+
+def edge_params(start_point, direction, edge_starts, edge_directions):
+    """
+    Solves START + t DIRECTION = EDGE_START + u EDGE_DIRECTION for every edge at once
+    using 2D cross products. Returns (t, u) arrays; parallel edges get nan.
+    """
+    profiler.count("intersection_tests", len(edge_starts))
+    dx, dy = direction[0], direction[1]
+    wx = edge_starts[:, 0] - start_point[0]
+    wy = edge_starts[:, 1] - start_point[1]
+    ex = edge_directions[:, 0]
+    ey = edge_directions[:, 1]
+    denom = dx * ey - dy * ex
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv = np.where(denom != 0, 1 / denom, np.nan)
+        t = (wx * ey - wy * ex) * inv
+        u = (wx * dy - wy * dx) * inv
+    return t, u
+
+
+def plain_params(sx, sy, dx, dy, qx, qy, ex, ey):
+    """
+    Solves (sx, sy) + t (dx, dy) = (qx, qy) + u (ex, ey) in plain floats without counting a test.
+    Returns (t, u) or None when the lines are parallel
+    """
+    denom = dx * ey - dy * ex
+    if denom == 0:
+        return None
+    wx, wy = qx - sx, qy - sy
+    return (wx * ey - wy * ex) / denom, (wx * dy - wy * dx) / denom
+
+
+def line_hit(sx, sy, dx, dy, qx, qy, ex, ey, min_param=MIN_PARAM):
+    """
+    The scalar hit test every search shares: t when the line crosses the edge (0 <= u <= 1)
+    further along than min_param, otherwise None. Callers count their intersection_tests
+    """
+    params = plain_params(sx, sy, dx, dy, qx, qy, ex, ey)
+    if params is not None and params[0] > min_param and 0 <= params[1] <= 1:
+        return params[0]
+    return None
+
+
+def valid_hits(t, u, min_param=MIN_PARAM):
+    """line_hit for arrays of t and u, parallel lines (nan) are never hits"""
+    return (t > min_param) & (u >= 0) & (u <= 1)
+
+
+def line_params(start_point, direction, other_start, other_direction):
+    """
+    edge_params for a single pair of lines in plain floats, for one off tests that don't need arrays.
+    Returns (t, u) or None when the lines are parallel
+    """
+    profiler.count("intersection_tests")
+    return plain_params(float(start_point[0]), float(start_point[1]), float(direction[0]), float(direction[1]),
+                        float(other_start[0]), float(other_start[1]), float(other_direction[0]),
+                        float(other_direction[1]))
+
+
+def row_edge_params(start_points, directions, edge_starts, edge_directions):
+    """edge_params for N lines each against its own edge, all arrays (N, 2). Returns (N,) t and u"""
+    profiler.count("intersection_tests", len(start_points))
+    wx = edge_starts[:, 0] - start_points[:, 0]
+    wy = edge_starts[:, 1] - start_points[:, 1]
+    dx, dy = directions[:, 0], directions[:, 1]
+    ex, ey = edge_directions[:, 0], edge_directions[:, 1]
+    denom = dx * ey - dy * ex
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv = np.where(denom != 0, 1 / denom, np.nan)
+        t = (wx * ey - wy * ex) * inv
+        u = (wx * dy - wy * dx) * inv
+    return t, u
+
+
+def nearest_hit(start_point, direction, edge_starts, edge_directions, min_param=MIN_PARAM):
+    """
+    Finds the nearest edge in front of the line START + t DIRECTION.
+    Returns (edge index, t) or (-1, inf) if nothing is hit.
+    Ties go to the edge that comes first, same as looping over the edges in order.
+    """
+    if len(edge_starts) == 0:
+        return -1, np.inf
+    t, u = edge_params(start_point, direction, edge_starts, edge_directions)
+    valid = valid_hits(t, u, min_param)
+    if not valid.any():
+        return -1, np.inf
+    t = np.where(valid, t, np.inf)
+    index = int(np.argmin(t))
+    return index, float(t[index])
+
+
+def _row_chunks(num_rows, num_edges, max_cells=1 << 22):
+    """Splits rows so an (N, E) temporary never gets bigger than max_cells"""
+    step = max(1, max_cells // max(num_edges, 1))
+    for lo in range(0, num_rows, step):
+        yield lo, min(lo + step, num_rows)
+
+
+def batch_edge_params(start_points, directions, edge_starts, edge_directions):
+    """edge_params for N lines at once. Returns (t, u) arrays of shape (N, E)"""
+    profiler.count("intersection_tests", len(start_points) * len(edge_starts))
+    wx = edge_starts[None, :, 0] - start_points[:, None, 0]
+    wy = edge_starts[None, :, 1] - start_points[:, None, 1]
+    dx = directions[:, None, 0]
+    dy = directions[:, None, 1]
+    ex = edge_directions[None, :, 0]
+    ey = edge_directions[None, :, 1]
+    denom = dx * ey - dy * ex
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv = np.where(denom != 0, 1 / denom, np.nan)
+        t = (wx * ey - wy * ex) * inv
+        u = (wx * dy - wy * dx) * inv
+    return t, u
+
+
+def nearest_hits(start_points, directions, edge_starts, edge_directions, min_param=MIN_PARAM):
+    """
+    nearest_hit for N lines at once.
+    Returns an (N,) array of edge indices (-1 for no hit) and an (N,) array of t (inf for no hit)
+    """
+    num_rows = len(start_points)
+    edges = np.full(num_rows, -1)
+    params = np.full(num_rows, np.inf)
+    if len(edge_starts) == 0:
+        return edges, params
+    for lo, hi in _row_chunks(num_rows, len(edge_starts)):
+        t, u = batch_edge_params(start_points[lo:hi], directions[lo:hi], edge_starts, edge_directions)
+        valid = valid_hits(t, u, min_param)
+        t = np.where(valid, t, np.inf)
+        nearest = np.argmin(t, axis=1)
+        rows = np.arange(hi - lo)
+        found = valid[rows, nearest]
+        edges[lo:hi] = np.where(found, nearest, -1)
+        params[lo:hi] = t[rows, nearest]
+    return edges, params
+
+
+
+class LineSearch:
+    """Base for the accelerators, which answer nearest(start_point, direction, min_param) one line at a time"""
+    def nearest(self, start_point, direction, min_param=MIN_PARAM):
+        raise NotImplementedError
+
+    def nearest_many(self, start_points, directions, min_param=MIN_PARAM):
+        """nearest for N lines, same contract as nearest_hits"""
+        edges = np.full(len(start_points), -1)
+        params = np.full(len(start_points), np.inf)
+        lines = zip(np.asarray(start_points, dtype=float).tolist(), np.asarray(directions, dtype=float).tolist())
+        for row, (start_point, direction) in enumerate(lines):
+            edges[row], params[row] = self.nearest(start_point, direction, min_param)
+        return edges, params
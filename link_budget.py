@@ -0,0 +1,95 @@
+import numpy as np
+from block import Map, Ray, Receiver
+
+
+class LinkBudget:
+    """
+    Adds up what every Receiver in a Map picks up during one or more traces.
+    A ray counts as incident on a receiver when it runs into it from outside,
+    or when a transmitter sits inside it.
+    Row i of every array is room_map.receivers[i]
+    """
+    path_dtype = np.dtype([("receiver", int), ("source", int), ("generation", int),
+                           ("power", float), ("path_length", float)])
+
+    def __init__(self, room_map: Map):
+        self.room_map = room_map
+        self.receivers = list(room_map.receivers)
+        # Map block index -> receiver row, -1 for blocks that aren't receivers.
+        # The extra last entry makes a block index of -1 (free space) look up -1 too
+        self.block_rows = np.full(len(room_map.blocks) + 1, -1)
+        self.rows = {}
+        for row, receiver in enumerate(self.receivers):
+            block_index = next(i for i, block in enumerate(room_map.blocks) if block is receiver)
+            self.block_rows[block_index] = row
+            self.rows[id(receiver)] = row
+        self.reset()
+
+    def reset(self):
+        self.power = np.zeros(len(self.receivers))
+        self.hits = np.zeros(len(self.receivers), dtype=int)
+        self.first_path = np.full(len(self.receivers), np.inf)
+        self._paths = []
+
+    def _paths_of(self, rows, sources, generations, powers, path_lengths):
+        paths = np.empty(len(rows), dtype=self.path_dtype)
+        paths["receiver"] = rows
+        paths["source"] = sources
+        paths["generation"] = generations
+        paths["power"] = powers
+        paths["path_length"] = path_lengths
+        return paths
+
+    def _add(self, rows, sources, generations, powers, path_lengths):
+        self.record_paths(self._paths_of(rows, sources, generations, powers, path_lengths))
+
+    def record_paths(self, paths):
+        """Adds incident paths (path_dtype, e.g. from incidents) to the totals"""
+        np.add.at(self.power, paths["receiver"], paths["power"])
+        np.add.at(self.hits, paths["receiver"], 1)
+        np.minimum.at(self.first_path, paths["receiver"], paths["path_length"])
+        self._paths.append(paths)
+
+    def record_ray(self, ray: Ray, generation=0, source=0):
+        """Records a single traced Ray"""
+        if generation == 0 and isinstance(ray.medium, Receiver):
+            self._add([self.rows[id(ray.medium)]], [source], [generation], [ray.power], [ray.travelled])
+        if isinstance(ray.hit_block, Receiver) and ray.hit_block is not ray.medium:
+            self._add([self.rows[id(ray.hit_block)]], [source], [generation], [ray.end_power],
+                      [ray.travelled + ray.path_length])
+
+    def record_segments(self, segments):
+        """Records every segment of a packet trace at once"""
+        self.record_paths(self.incidents(segments))
+
+    def incidents(self, segments):
+        """The incident paths in a packet trace as a path_dtype array, without adding them to the totals"""
+        starts = self.block_rows[segments.medium]
+        inside = np.flatnonzero((segments.generation == 0) & (segments.medium >= 0) & (starts >= 0))
+        ends = self.block_rows[segments.hit_block]
+        entering = np.flatnonzero((segments.hit_block >= 0) & (ends >= 0) & (segments.hit_block != segments.medium))
+        return np.concatenate([
+            self._paths_of(starts[inside], segments.source[inside], segments.generation[inside],
+                           segments.power[inside], segments.travelled[inside]),
+            self._paths_of(ends[entering], segments.source[entering], segments.generation[entering],
+                           segments.end_power[entering], segments.travelled[entering] + segments.length[entering])])
+
+    def hit_receivers(self):
+        return [receiver for receiver, hits in zip(self.receivers, self.hits) if hits > 0]
+
+    def paths(self):
+        """Every incident path as a structured array, receiver is the row in table()"""
+        if not self._paths:
+            return np.zeros(0, dtype=self.path_dtype)
+        return np.concatenate(self._paths)
+
+    def table(self):
+        """One row per receiver with its name, total incident power, hit count and shortest path"""
+        name_length = max([len(receiver.name) for receiver in self.receivers] + [1])
+        table = np.empty(len(self.receivers), dtype=[("name", f"U{name_length}"), ("power", float),
+                                                     ("hits", int), ("first_path", float)])
+        table["name"] = [receiver.name for receiver in self.receivers]
+        table["power"] = self.power
+        table["hits"] = self.hits
+        table["first_path"] = self.first_path
+        return table
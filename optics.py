@@ -0,0 +1,87 @@
+"""
+Closed form reflection and refraction.
+The scalar functions take and return plain floats so a single bounce allocates nothing.
+The _many versions do the same for (N, 2) arrays of directions and normals.
+Normals must be unit length, either side of the boundary works.
+"""
+from math import sqrt
+import numpy as np
+
+
+def reflect(dx, dy, nx, ny):
+    """Mirrors the direction on a boundary with normal n: d - 2(d.n)n"""
+    dot = dx * nx + dy * ny
+    return dx - 2 * dot * nx, dy - 2 * dot * ny
+
+
+def refract(dx, dy, nx, ny, refraction_i, refraction_r):
+    """
+    Snell's law in vector form for a unit direction d going from index refraction_i into refraction_r.
+    Returns the unit transmitted direction, or None on total internal reflection
+    """
+    dot = dx * nx + dy * ny
+    par_x, par_y = dx - dot * nx, dy - dot * ny
+    ratio = refraction_i / refraction_r
+    if sqrt(par_x * par_x + par_y * par_y) > 1 / ratio:
+        return None
+    t_par_x, t_par_y = ratio * par_x, ratio * par_y
+    t_perp = sqrt(max(1 - (t_par_x * t_par_x + t_par_y * t_par_y), 0))
+    # The transmitted ray carries on through the boundary on the same side as it arrived
+    if dot < 0:
+        t_perp = -t_perp
+    return t_par_x + t_perp * nx, t_par_y + t_perp * ny
+
+
+def reflect_many(directions, normals):
+    """reflect for (N, 2) arrays"""
+    dot = np.einsum("ij,ij->i", directions, normals)
+    return directions - 2 * dot[:, None] * normals
+
+
+def refract_many(directions, normals, refraction_i, refraction_r):
+    """
+    refract for (N, 2) arrays with (N,) refraction indices.
+    Returns the transmitted directions and a mask of rows that aren't totally reflected
+    """
+    dot = np.einsum("ij,ij->i", directions, normals)
+    parallel = directions - dot[:, None] * normals
+    ratio = refraction_i / refraction_r
+    transmits = np.sqrt(np.einsum("ij,ij->i", parallel, parallel)) <= 1 / ratio
+    t_par = ratio[:, None] * parallel
+    t_perp = np.sqrt(np.clip(1 - np.einsum("ij,ij->i", t_par, t_par), 0, None))
+    t_perp = np.where(dot < 0, -t_perp, t_perp)
+    return t_par + t_perp[:, None] * normals, transmits
+
+
+def fresnel_reflectance(cos_i, refraction_i, refraction_r):
+    """
+    Fraction of unpolarised power reflected at a boundary, the average of the s and p Fresnel terms.
+    cos_i is the cosine of the angle between the ray and the normal. Total internal reflection gives 1
+    """
+    cos_i = abs(cos_i)
+    ratio = refraction_i / refraction_r
+    sin_t_sq = ratio * ratio * (1 - cos_i * cos_i)
+    if sin_t_sq >= 1:
+        return 1.0
+    cos_t = sqrt(1 - sin_t_sq)
+    r_s = (refraction_i * cos_i - refraction_r * cos_t) / (refraction_i * cos_i + refraction_r * cos_t)
+    r_p = (refraction_i * cos_t - refraction_r * cos_i) / (refraction_i * cos_t + refraction_r * cos_i)
+    return (r_s * r_s + r_p * r_p) / 2
+
+
+def fresnel_reflectance_many(cos_i, refraction_i, refraction_r):
+    """fresnel_reflectance for (N,) arrays"""
+    cos_i = np.abs(cos_i)
+    ratio = refraction_i / refraction_r
+    sin_t_sq = ratio * ratio * (1 - cos_i * cos_i)
+    cos_t = np.sqrt(np.clip(1 - sin_t_sq, 0, None))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r_s = (refraction_i * cos_i - refraction_r * cos_t) / (refraction_i * cos_i + refraction_r * cos_t)
+        r_p = (refraction_i * cos_t - refraction_r * cos_i) / (refraction_i * cos_t + refraction_r * cos_i)
+    reflectance = (r_s * r_s + r_p * r_p) / 2
+    return np.where(sin_t_sq >= 1, 1.0, np.nan_to_num(reflectance, nan=1.0))
+
+
+def absorb(power, absorption_coeff, length):
+    """Beer-Lambert law, power left after travelling length through the medium"""
+    return power * np.exp(-absorption_coeff * length)
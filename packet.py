@@ -0,0 +1,226 @@
+import numpy as np
+import profiler
+from block import Map
+from optics import reflect_many, refract_many, fresnel_reflectance_many, absorb
+from link_budget import LinkBudget
+
+# Kinds of segment
+HEAD = 0
+REFLECTED = 1
+REFRACTED = 2
+
+# Rays that hit nothing are drawn this far, same as Ray.end_point
+MISS_LENGTH = 10000
+
+
+class Segments:
+    """
+    Struct of arrays holding every segment of a packet trace, one row per segment.
+    power is the power at the start of a segment and end_power what reaches its end.
+    travelled is the distance from the transmitter to the start of the segment.
+    Block and edge columns index into Map.blocks and Map.boundaries, -1 means none.
+    parent is the row of the segment that spawned this one (-1 for head rays)
+    and source is the head ray the segment descends from
+    """
+    fields = ("start", "end", "direction", "length", "travelled", "power", "end_power", "medium", "hit_block",
+              "edge", "parent", "generation", "source", "kind")
+    vector_fields = ("start", "end", "direction")
+    float_fields = ("length", "travelled", "power", "end_power")
+
+    def __init__(self, start, end, direction, length, travelled, power, end_power, medium, hit_block, edge, parent,
+                 generation, source, kind):
+        self.start = start
+        self.end = end
+        self.direction = direction
+        self.length = length
+        self.travelled = travelled
+        self.power = power
+        self.end_power = end_power
+        self.medium = medium
+        self.hit_block = hit_block
+        self.edge = edge
+        self.parent = parent
+        self.generation = generation
+        self.source = source
+        self.kind = kind
+
+    def __len__(self):
+        return len(self.start)
+
+    def __repr__(self):
+        return f"Segments({len(self)} segments)"
+
+    @classmethod
+    def empty(cls):
+        columns = []
+        for field in cls.fields:
+            if field in cls.vector_fields:
+                columns.append(np.zeros((0, 2)))
+            elif field in cls.float_fields:
+                columns.append(np.zeros(0))
+            else:
+                columns.append(np.zeros(0, dtype=int))
+        return cls(*columns)
+
+    @classmethod
+    def concatenate(cls, parts):
+        return cls(*[np.concatenate([getattr(part, field) for part in parts]) for field in cls.fields])
+
+
+def block_values(values, blocks, free_space):
+    """Looks up a per block array for each block index, -1 (free space) gets free_space"""
+    # The extra last entry makes a block index of -1 look up free_space, even when there are no blocks
+    return np.append(np.asarray(values, dtype=float), free_space)[blocks]
+
+
+def split_at_boundary(room_map: Map, directions, medium, hit_block, edges):
+    """
+    Reflected and refracted directions of N rays arriving at boundaries edges (no misses), all arrays (N,).
+    Returns the reflected directions, the reflectance (edges without a reflectivity use Fresnel,
+    totally reflected rays get 1), the transmitted directions and a mask of the rays that refract,
+    which is every ray unless the boundary is a perfect mirror or the ray is totally reflected
+    """
+    normals = room_map.edge_normals[edges]
+    reflected = reflect_many(directions, normals)
+    refraction_i = block_values(room_map.refraction_indices, medium, 1.0)
+    refraction_r = block_values(room_map.refraction_indices, hit_block, 1.0)
+    reflectivity = room_map.edge_reflectivity[edges]
+    fresnel = fresnel_reflectance_many(np.einsum("ij,ij->i", directions, normals), refraction_i, refraction_r)
+    transmitted, transmits = refract_many(directions, normals, refraction_i, refraction_r)
+    # Total internal reflection sends everything back, whatever the boundary's reflectivity
+    reflectance = np.where(transmits, np.where(np.isnan(reflectivity), fresnel, reflectivity), 1.0)
+    profiler.count("total_internal_reflections", int(np.sum(~transmits & (reflectivity != 1))))
+    return reflected, reflectance, transmitted, transmits & (reflectivity != 1)
+
+
+def trace_packet(room_map: Map, origins, directions, powers=1, iterations=3,
+                 power_threshold=0, max_segments=None) -> Segments:
+    """
+    Traces N rays at once, a whole bounce generation per step.
+    Gives the same segments as running get_all_rays on each ray, but in generation order
+    and with unit directions throughout.
+    origins and directions are (N, 2), powers is a scalar or (N,).
+    Pruning works like tracer.trace_ray: only rays ending with at least power_threshold spawn children,
+    iterations caps the depth and max_segments caps the total segments
+    """
+    with profiler.call("trace_packet"):
+        start, direction, power = _head_rays(origins, directions, powers)
+        medium = room_map.blocks_enclosed(start, direction)
+        return _trace_generations(room_map, start, direction, power, medium, iterations, power_threshold,
+                                  max_segments)
+
+
+def stream_packet(room_map: Map, origins, directions, powers=1, iterations=3, power_threshold=0,
+                  max_segments=None, batch_rays=1024):
+    """
+    trace_packet as a generator, for consumers that write or add up segments as they come.
+    The head rays are traced batch_rays at a time and every generation of a batch is yielded
+    as (segments, hits) where hits are the receiver hits in it, see LinkBudget.incidents.
+    Nothing is traced until the next batch is asked for, so memory stays around one batch's widest generation.
+    source is the head ray's index in origins and parent counts rows across the whole stream.
+    max_segments caps the whole stream, spent by the batches in order
+    """
+    start, direction, power = _head_rays(origins, directions, powers)
+    budget = LinkBudget(room_map)
+    row = 0
+    for lo in range(0, len(start), batch_rays):
+        remaining = None if max_segments is None else max_segments - row
+        if remaining is not None and remaining <= 0:
+            break
+        hi = min(lo + batch_rays, len(start))
+        if remaining is not None:
+            hi = min(hi, lo + remaining)
+        medium = room_map.blocks_enclosed(start[lo:hi], direction[lo:hi])
+        for segments in _iter_generations(room_map, start[lo:hi], direction[lo:hi], power[lo:hi], medium,
+                                          iterations, power_threshold, remaining, first_row=row, first_source=lo):
+            row += len(segments)
+            yield segments, budget.incidents(segments)
+
+
+def _head_rays(origins, directions, powers):
+    """origins and unit directions as (N, 2) float arrays and powers as (N,)"""
+    start = np.asarray(origins, dtype=float).reshape(-1, 2)
+    direction = np.asarray(directions, dtype=float).reshape(-1, 2)
+    direction = direction / np.linalg.norm(direction, axis=1)[:, None]
+    power = np.broadcast_to(np.asarray(powers, dtype=float), (len(start),)).copy()
+    return start, direction, power
+
+
+def _trace_generations(room_map: Map, start, direction, power, medium, iterations, power_threshold, max_segments,
+                       find_hits=None) -> Segments:
+    """
+    The generation loop of trace_packet, from head rays with unit directions and known media.
+    find_hits(start, direction, parent, kind) gives each generation's (edges, params) in place of
+    Map.nearest_boundaries, it is how a TraceSession reuses a previous trace
+    """
+    parts = list(_iter_generations(room_map, start, direction, power, medium, iterations, power_threshold,
+                                   max_segments, find_hits))
+    if not parts:
+        return Segments.empty()
+    return Segments.concatenate(parts)
+
+
+def _iter_generations(room_map: Map, start, direction, power, medium, iterations, power_threshold, max_segments,
+                      find_hits=None, first_row=0, first_source=0):
+    """
+    Yields the Segments of each generation as _trace_generations works them out.
+    Rows are numbered from first_row and head rays from first_source
+    """
+    num_rays = len(start)
+    travelled = np.zeros(num_rays)
+    parent = np.full(num_rays, -1)
+    source = first_source + np.arange(num_rays)
+    kind = np.full(num_rays, HEAD)
+
+    offset = 0
+    for generation in range(iterations + 1):
+        count = len(start)
+        if count == 0:
+            break
+        profiler.count("rays", count)
+        if find_hits is None:
+            edge, param = room_map.nearest_boundaries(start, direction)
+        else:
+            edge, param = find_hits(start, direction, parent, kind)
+        hit = edge >= 0
+        length = np.where(hit, param, MISS_LENGTH)
+        end = start + length[:, None] * direction
+        hit_block = np.full(count, -1)
+        hit_block[hit] = room_map.far_side_blocks(edge[hit], end[hit], direction[hit])
+        end_power = absorb(power, block_values(room_map.absorption_coeffs, medium, 0.0), length)
+        yield Segments(start, end, direction, length, travelled, power, end_power, medium, hit_block, edge,
+                       parent, np.full(count, generation), source, kind)
+        rows = first_row + offset + np.arange(count)
+        offset += count
+        if generation == iterations:
+            break
+        if max_segments is not None and offset >= max_segments:
+            break
+
+        # Every ray that hit something reflects, some also refract
+        hits = np.flatnonzero(hit & (end_power >= power_threshold))
+        with profiler.stage("split"):
+            reflected, split, transmitted, refracts = split_at_boundary(room_map, direction[hits], medium[hits],
+                                                                         hit_block[hits], edge[hits])
+        reflectance = np.zeros(count)
+        reflectance[hits] = split
+        passes = hits[refracts]
+        transmitted = transmitted[refracts]
+
+        children = np.concatenate([hits, passes])
+        direction = np.concatenate([reflected, transmitted]).reshape(-1, 2)
+        kind = np.concatenate([np.full(len(hits), REFLECTED), np.full(len(passes), REFRACTED)])
+        if max_segments is not None and offset + len(children) > max_segments:
+            keep = max_segments - offset
+            children, direction, kind = children[:keep], direction[:keep], kind[:keep]
+        profiler.count("reflections", int(np.sum(kind == REFLECTED)))
+        profiler.count("refractions", int(np.sum(kind == REFRACTED)))
+        start = end[children]
+        travelled = travelled[children] + length[children]
+        direction = direction / np.linalg.norm(direction, axis=1)[:, None]
+        power = end_power[children] * np.where(kind == REFLECTED, reflectance[children], 1 - reflectance[children])
+        # Reflected rays stay in the medium they came from, refracted rays go into the block they hit
+        medium = np.where(kind == REFLECTED, medium[children], hit_block[children])
+        parent = rows[children]
+        source = source[children]
+
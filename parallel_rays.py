@@ -1,63 +1,16 @@
+import numpy as np
 import pygame, sys
-from block import Block, Map, Receiver, Ray
-from tracer import find_direction, get_all_rays, get_hit_medium, receiver_hit
+from scenes import parallel_rays_map
+from renderer import SceneLayer
+from tracer import find_direction
+from session import TraceSession
+from link_budget import LinkBudget
+from worker import TraceWorker
 
 #---------------------------------------------------------------------------------------------------------
 # Create environment
-def get_square(top_left_corner, side_length):
-    corner1 = top_left_corner
-    corner2 = (top_left_corner[0] + side_length, top_left_corner[1])
-    corner3 = (top_left_corner[0] + side_length, top_left_corner[1] + side_length)
-    corner4 = (top_left_corner[0], top_left_corner[1] + side_length)
-    return (corner1, corner2, corner3, corner4)
-
-def draw_all_ray(data_list):
-    for ray_i in data_list:
-        if ray_i is not None:
-            ray_i.draw_ray(surface)
-
-square_coord = get_square((10,10), 50)
-
-square = Block(
-    name="square",
-    refraction_index=1.2,
-    colour=(255,0,0, 127),
-    absorption_coeff=1,
-    reflectivity=0,
-    vertices=((10,140),(450,140),(450,390))
-)
-
-square_2 = Receiver(
-    name="square2",
-    refraction_index=36,
-    init_colour=(0,255,0, 127),
-    receive_colour=(0,100, 0, 127),
-    absorption_coeff=1,
-    reflectivity=0,
-    vertices=square_coord
-)
-
-lens = Receiver(
-    name="lens",
-    refraction_index=1.2,
-    init_colour = (255,255,255,255),
-    receive_colour=(100,100,100,255),
-    absorption_coeff=1,
-    reflectivity=0,
-    vertices=((440, 400), (420, 340), (410, 280), (410, 220), (420, 160), (440, 100),
-              (450, 100), (470, 160), (480, 220), (480, 280), (470, 340), (450, 400))
-)
-
-room = Block(
-    name="room",
-    refraction_index=1,
-    colour=(0,0,0, 127),
-    absorption_coeff=1,
-    reflectivity=1,
-    vertices=((0,0), (1000,0), (1000, 500),(0,500))
-)
-# When blocks overlap, the block that is at define at the start of "Map" will matter the most
-room_map = Map(lens)
+# The blocks are defined in scenes.py
+room_map = parallel_rays_map()
 #---------------------------------------------------------------------------------------------------------
 # Game variables
 pygame.init()
@@ -65,6 +18,7 @@ WIDTH = 1000
 HEIGHT = 500
 surface = pygame.display.set_mode((WIDTH, HEIGHT))
 clock = pygame.time.Clock()
+scene_layer = SceneLayer(room_map)
 
 angle = 0
 pos_1 = [50, 50]
@@ -78,39 +32,35 @@ all_pos = [pos_1, pos_2, pos_3, pos_4, pos_5]
 iterations =5
 
 
-ray_1 = Ray(find_direction(angle), 1, pos_1, room_map)
-ray_2 = Ray(find_direction(angle), 1, pos_2, room_map)
-ray_3 = Ray(find_direction(angle), 1, pos_3, room_map)
-ray_4 = Ray(find_direction(angle), 1, pos_4, room_map)
-ray_5 = Ray(find_direction(angle), 1, pos_5, room_map)
-all_rays = [ray_1, ray_2, ray_3, ray_4, ray_5]
+# The whole beam is traced as one packet, the session reuses the last trace as the transmitters move
+session = TraceSession(room_map)
+def house_keeping(origins, angle):
+    directions = np.tile(find_direction(angle), (len(origins), 1))
+    segments = session.trace(origins, directions)
+    budget = LinkBudget(room_map)
+    budget.record_segments(segments)
+    return segments, budget
 
-ray_1_length = ray_1.shortest_path
+# Traces run on a background thread, the loop below keeps drawing the last finished one
+worker = TraceWorker(house_keeping)
+worker.submit(np.array(all_pos, dtype=float), angle)
+all_segments, budget = worker.wait()
 
-def house_keeping(ray):
-    data_list = get_all_rays(ray)
-    hit_blocks = get_hit_medium(data_list)
-    receivers_hit = receiver_hit(hit_blocks)
-    return data_list, receivers_hit
+ray_1_length = np.inf
+if all_segments.edge[0] >= 0:
+    ray_1_length = np.linalg.norm(all_segments.end[0] - all_segments.start[0])
 
-all_list = []
-all_hits = []
-for ray_i in all_rays:
-    li, ri = house_keeping(ray_i)
-    all_list.append(li)
-    all_hits += ri
-
-for receiver in room_map.receivers:
-    if receiver in all_hits:
-        receiver.change_colour(hit=True)
-    else:
-        receiver.change_colour(hit=False)
+for receiver, hits in zip(budget.receivers, budget.hits):
+    receiver.change_colour(hit=hits > 0)
 
 
 print("length of head node in ray 1")
 print(ray_1_length)
 
 move_speed = 10
+# Milliseconds per frame at 60 fps, move_speed is per frame at that rate
+FRAME_TIME = 1000 / 60
+frame_time = FRAME_TIME
 down_key = False
 up_key = False
 w_key = False
@@ -154,54 +104,40 @@ while True:
 
     down = [down_key, up_key, w_key, a_key, s_key, d_key]
     up = [not n for n in down]
+    # Movement is scaled by the frame time so it keeps the same speed when frames run late
+    step = frame_time / FRAME_TIME
     if down_key:
-        angle += 1
-        # print(ray_1)
-        for ray_j in all_rays:
-            ray_j.new_trajectory(find_direction(angle))
+        angle += step
     if up_key:
-        angle -= 1
-        for ray_j in all_rays:
-            ray_j.new_trajectory(find_direction(angle))
-        # print(ray_1)
+        angle -= step
     if w_key:
-        for pos_i, ray_i in zip(all_pos, all_rays):
-            pos_i[1] -= move_speed
-            ray_i.move_start(pos_i)
+        for pos_i in all_pos:
+            pos_i[1] -= move_speed * step
     if s_key:
-        for pos_i, ray_i in zip(all_pos, all_rays):
-            pos_i[1] += move_speed
-            ray_i.move_start(pos_i)
+        for pos_i in all_pos:
+            pos_i[1] += move_speed * step
     if a_key:
-        for pos_i, ray_i in zip(all_pos, all_rays):
-            pos_i[0] -= move_speed
-            ray_i.move_start(pos_i)
+        for pos_i in all_pos:
+            pos_i[0] -= move_speed * step
     if d_key:
-        for pos_i, ray_i in zip(all_pos, all_rays):
-            pos_i[0] += move_speed
-            ray_i.move_start(pos_i)
+        for pos_i in all_pos:
+            pos_i[0] += move_speed * step
 
     if not all(up):
-        all_list = []
-        all_hits = []
-        for ray_i in all_rays:
-            li, ri = house_keeping(ray_i)
-            all_list.append(li)
-            all_hits += ri
-        for receiver in room_map.receivers:
-            if receiver in all_hits:
-                receiver.change_colour(hit=True)
-            else:
-                receiver.change_colour(hit=False)
-
-    pygame.draw.rect(surface, (0, 0, 0), (0, 0, WIDTH, HEIGHT))
-    
-    room_map.draw_map(surface)
-    for li in all_list:
-        draw_all_ray(li)
+        # Replaces any pose the worker hasn't started on yet
+        worker.submit(np.array(all_pos, dtype=float), angle)
+    result = worker.poll()
+    if result is not None:
+        all_segments, budget = result
+        for receiver, hits in zip(budget.receivers, budget.hits):
+            receiver.change_colour(hit=hits > 0)
+
+    # Only redrawn when the segments or a receiver's colour change
+    scene_layer.draw(surface, all_segments)
 
     for pos_i in all_pos:
         pygame.draw.circle(surface, (255,255,255, 255), pos_i, 4)
 
     pygame.display.flip()
-    clock.tick(60)
\ No newline at end of file
+    # Capped so a stall (like the first frame) doesn't make the transmitter jump
+    frame_time = min(clock.tick(60), 100)
\ No newline at end of file
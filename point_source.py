@@ -1,84 +1,17 @@
-from numpy import number
+import numpy as np
 import pygame, sys
-from block import Block, Map, Receiver, Ray
-from tracer import find_direction, get_all_rays, get_hit_medium, receiver_hit
+from scenes import point_source_map
+from renderer import SceneLayer
+from tracer import find_direction
+from session import TraceSession
+from link_budget import LinkBudget
+from worker import TraceWorker
+from progressive import ProgressiveTracer
 
 #---------------------------------------------------------------------------------------------------------
 # Create environment
-def get_square(top_left_corner, side_length):
-    corner1 = top_left_corner
-    corner2 = (top_left_corner[0] + side_length, top_left_corner[1])
-    corner3 = (top_left_corner[0] + side_length, top_left_corner[1] + side_length)
-    corner4 = (top_left_corner[0], top_left_corner[1] + side_length)
-    return (corner1, corner2, corner3, corner4)
-
-def draw_all_ray(data_list):
-    for ray_i in data_list:
-        if ray_i is not None:
-            ray_i.draw_ray(surface)
-
-square_coord = get_square((10,10), 10)
-
-square = Block(
-    name="square",
-    refraction_index=100,
-    colour=(255,0,0, 127),
-    absorption_coeff=1,
-    reflectivity=0,
-    vertices=((10,140),(450,140),(450,390))
-)
-
-square_2 = Receiver(
-    name="square2",
-    refraction_index=36,
-    init_colour=(0,255,0, 127),
-    receive_colour=(0,100, 0, 127),
-    absorption_coeff=1,
-    reflectivity=0,
-    vertices=get_square((10,10), 10)
-)
-
-square_3 = Receiver(
-    name="square3",
-    refraction_index=36,
-    init_colour=(0,255,0, 127),
-    receive_colour=(0,100, 0, 127),
-    absorption_coeff=1,
-    reflectivity=0,
-    vertices=get_square((100,10), 10)
-)
-
-square_4 = Receiver(
-    name="square4",
-    refraction_index=36,
-    init_colour=(0,255,0, 127),
-    receive_colour=(0,100, 0, 127),
-    absorption_coeff=1,
-    reflectivity=0,
-    vertices=get_square((539,246), 10)
-)
-
-lens = Receiver(
-    name="lens",
-    refraction_index=36,
-    init_colour = (255,255,255,255),
-    receive_colour=(100,100,100,255),
-    absorption_coeff=1,
-    reflectivity=0,
-    vertices=((440, 400), (420, 340), (410, 280), (410, 220), (420, 160), (440, 100),
-              (450, 100), (470, 160), (480, 220), (480, 280), (470, 340), (450, 400))
-)
-
-room = Block(
-    name="room",
-    refraction_index=1,
-    colour=(0,0,0, 127),
-    absorption_coeff=1,
-    reflectivity=1,
-    vertices=((0,0), (1000,0), (1000, 500),(0,500))
-)
-# When blocks overlap, the block that is at define at the start of "Map" will matter the most
-room_map = Map(square, square_2, square_3, square_4)
+# The blocks are defined in scenes.py
+room_map = point_source_map()
 #---------------------------------------------------------------------------------------------------------
 # Game variables
 pygame.init()
@@ -86,6 +19,7 @@ WIDTH = 1000
 HEIGHT = 500
 surface = pygame.display.set_mode((WIDTH, HEIGHT))
 clock = pygame.time.Clock()
+scene_layer = SceneLayer(room_map)
 
 angle = 0
 pos_1 = [50, 50]
@@ -104,45 +38,47 @@ for i in range(number_of_rays):
     angle = 360/number_of_rays * i
     all_angles.append(angle)
 
-all_rays = []
-for angle in all_angles:
-    ray_i = Ray(find_direction(angle), 1, pos_1, room_map)
-    all_rays.append(ray_i)
-
-
-# ray_1 = Ray(find_direction(angle), 1, pos_1, room_map)
-# ray_2 = Ray(find_direction(angle), 1, pos_2, room_map)
-# ray_3 = Ray(find_direction(angle), 1, pos_3, room_map)
-# ray_4 = Ray(find_direction(angle), 1, pos_4, room_map)
-# ray_5 = Ray(find_direction(angle), 1, pos_5, room_map)
-# all_rays = [ray_1, ray_2, ray_3, ray_4, ray_5]
-
-# ray_1_length = ray_1.shortest_path
-
-def house_keeping(ray):
-    data_list = get_all_rays(ray)
-    hit_blocks = get_hit_medium(data_list)
-    receivers_hit = receiver_hit(hit_blocks)
-    return data_list, receivers_hit
-
-all_list = []
-all_hits = []
-for ray_i in all_rays:
-    li, ri = house_keeping(ray_i)
-    all_list.append(li)
-    all_hits += ri
-
-for receiver in room_map.receivers:
-    if receiver in all_hits:
-        receiver.change_colour(hit=True)
-    else:
-        receiver.change_colour(hit=False)
+# The whole fan is traced as one packet, the session reuses the last trace as the transmitter moves
+session = TraceSession(room_map)
+all_directions = np.array([find_direction(angle) for angle in all_angles])
+
+def receiver_budget(segments):
+    budget = LinkBudget(room_map)
+    budget.record_segments(segments)
+    return budget
+
+def house_keeping(origin, directions):
+    origins = np.tile(origin, (len(directions), 1))
+    segments = session.trace(origins, directions)
+    return segments, receiver_budget(segments)
+
+# With progressive on, a coarse shallow fan is traced while the transmitter moves and it is refined
+# over the next frames once it stops, spending at most frame_budget seconds of each frame (see progressive.py)
+# Otherwise traces run on a background thread, the loop below keeps drawing the last finished one
+progressive = False
+frame_budget = 0.008
+if progressive:
+    progressive_tracer = ProgressiveTracer(room_map, levels=((number_of_rays, 1), (number_of_rays * 4, 3),
+                                                             (number_of_rays * 16, iterations)),
+                                           frame_budget=frame_budget)
+    all_segments = progressive_tracer.move(pos_1, angle)
+    budget = receiver_budget(all_segments)
+else:
+    worker = TraceWorker(house_keeping)
+    worker.submit(list(pos_1), all_directions)
+    all_segments, budget = worker.wait()
+
+for receiver, hits in zip(budget.receivers, budget.hits):
+    receiver.change_colour(hit=hits > 0)
 
 
 print("length of head node in ray 1")
 # print(ray_1_length)
 
 move_speed = 10
+# Milliseconds per frame at 60 fps, move_speed is per frame at that rate
+FRAME_TIME = 1000 / 60
+frame_time = FRAME_TIME
 down_key = False
 up_key = False
 w_key = False
@@ -186,69 +122,46 @@ while True:
 
     down = [down_key, up_key, w_key, a_key, s_key, d_key]
     up = [not n for n in down]
+    # Movement is scaled by the frame time so it keeps the same speed when frames run late
+    step = frame_time / FRAME_TIME
     if down_key:
-        angle += 1
-        for ray_angle, ray_j in zip(all_angles, all_rays):
-            ray_j.new_trajectory(find_direction(ray_angle + angle))
+        angle += step
+        all_directions = np.array([find_direction(ray_angle + angle) for ray_angle in all_angles])
     if up_key:
-        angle -= 1
-        for ray_angle, ray_j in zip(all_angles, all_rays):
-            ray_j.new_trajectory(find_direction(ray_angle + angle))
-        # print(ray_1)
+        angle -= step
+        all_directions = np.array([find_direction(ray_angle + angle) for ray_angle in all_angles])
     if w_key:
-        # for pos_i, ray_i in zip(all_pos, all_rays):
-        #     pos_i[1] -= move_speed
-        #     ray_i.move_start(pos_i)
-        pos_1[1] -= move_speed
-        for ray_i in all_rays:
-            ray_i.move_start(pos_1)
-
+        pos_1[1] -= move_speed * step
     if s_key:
-        # for pos_i, ray_i in zip(all_pos, all_rays):
-        #     pos_i[1] += move_speed
-        #     ray_i.move_start(pos_i)
-        pos_1[1] += move_speed
-        for ray_i in all_rays:
-            ray_i.move_start(pos_1)
+        pos_1[1] += move_speed * step
     if a_key:
-        # for pos_i, ray_i in zip(all_pos, all_rays):
-        #     pos_i[0] -= move_speed
-        #     ray_i.move_start(pos_i)
-        pos_1[0] -= move_speed
-        for ray_i in all_rays:
-            ray_i.move_start(pos_1)
+        pos_1[0] -= move_speed * step
     if d_key:
-        # for pos_i, ray_i in zip(all_pos, all_rays):
-        #     pos_i[0] += move_speed
-        #     ray_i.move_start(pos_i)
-        pos_1[0] += move_speed
-        for ray_i in all_rays:
-            ray_i.move_start(pos_1)
-
-    if not all(up):
-        all_list = []
-        all_hits = []
-        for ray_i in all_rays:
-            li, ri = house_keeping(ray_i)
-            all_list.append(li)
-            all_hits += ri
-        hit_receivers = []
-        for receiver in room_map.receivers:
-            if receiver in all_hits:
-                hit_receivers.append(receiver)
-                receiver.change_colour(hit=True)
-            else:
-                receiver.change_colour(hit=False)
-        print(hit_receivers)
-
-    pygame.draw.rect(surface, (0, 0, 0), (0, 0, WIDTH, HEIGHT))
-    
-    room_map.draw_map(surface)
-    for li in all_list:
-        draw_all_ray(li)
+        pos_1[0] += move_speed * step
+
+    if progressive:
+        if not all(up):
+            segments = progressive_tracer.move(pos_1, angle)
+        else:
+            segments = progressive_tracer.step()
+        result = None if segments is None else (segments, receiver_budget(segments))
+    else:
+        if not all(up):
+            # Replaces any pose the worker hasn't started on yet
+            worker.submit(list(pos_1), all_directions)
+        result = worker.poll()
+    if result is not None:
+        all_segments, budget = result
+        for receiver, hits in zip(budget.receivers, budget.hits):
+            receiver.change_colour(hit=hits > 0)
+        print(budget.table())
+
+    # Only redrawn when the segments or a receiver's colour change
+    scene_layer.draw(surface, all_segments)
 
     # for pos_i in all_pos:
     pygame.draw.circle(surface, (255,255,255, 255), pos_1, 4)
 
     pygame.display.flip()
-    clock.tick(60)
\ No newline at end of file
+    # Capped so a stall (like the first frame) doesn't make the transmitter jump
+    frame_time = min(clock.tick(60), 100)
\ No newline at end of file
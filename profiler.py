@@ -0,0 +1,163 @@
+"""
+Opt-in instrumentation for the tracer. Nothing is recorded unless a Profiler is started,
+the hooks in the tracer cost a function call and a None check otherwise.
+
+    profiler = Profiler(exporter=lambda counters: print(counters.as_dict()))
+    with profiler:
+        with profiler.frame():
+            session.trace(origins, directions)
+
+Counters kept by the tracer:
+- rays: rays and segments spawned, heads included
+- intersection_tests: ray against edge tests, in the brute force kernels and the accelerators
+- containment_queries: points looked up in the ContainmentIndex
+- reflections, refractions: children spawned of each kind
+- total_internal_reflections: refractions that didn't happen because of total internal reflection
+- session_searched: TraceSession segments that couldn't reuse their last hit and searched every boundary
+
+Time goes to named stages (intersect, containment, split, and match in a TraceSession). Stage times exclude stages nested inside them.
+Each trace call (trace_packet, TraceSession.trace, get_all_rays) gets its own Counters, the calls
+made inside Profiler.frame are added up into the frame's Counters. A profiler is meant for one thread
+"""
+import time
+from contextlib import contextmanager, nullcontext
+
+# The started Profiler, None when instrumentation is off
+active = None
+
+_NOTHING = nullcontext()
+
+
+class Counters:
+    """
+    Counts and seconds per stage for one trace call, one frame or a whole run.
+    elapsed is the wall time of the call or frame and calls holds the Counters of the trace calls inside a frame
+    """
+    def __init__(self, name):
+        self.name = name
+        self.counts = {}
+        self.seconds = {}
+        self.elapsed = 0.0
+        self.calls = []
+
+    def __repr__(self):
+        return f"Counters({self.name!r}, {self.counts}, {self.seconds})"
+
+    def add(self, other):
+        for name, value in other.counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+        for name, value in other.seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + value
+
+    def as_dict(self):
+        result = {"name": self.name, "elapsed": self.elapsed, "counts": dict(self.counts),
+                  "seconds": dict(self.seconds)}
+        if self.calls:
+            result["calls"] = [call.as_dict() for call in self.calls]
+        return result
+
+
+class Profiler:
+    """
+    Collects the tracer's counters while started.
+    exporter is called with the Counters of every finished frame,
+    and of every trace call made outside a frame.
+    total adds up everything since the profiler was made, last_call and last_frame are the latest of each
+    """
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self.total = Counters("total")
+        self.last_call = None
+        self.last_frame = None
+        self._scopes = []
+        self._stages = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        global active
+        active = self
+
+    def stop(self):
+        global active
+        if active is self:
+            active = None
+
+    def count(self, name, n=1):
+        counters = self._scopes[-1] if self._scopes else self.total
+        counters.counts[name] = counters.counts.get(name, 0) + int(n)
+
+    @contextmanager
+    def stage(self, name):
+        # Each open stage is [name, start, seconds spent in stages nested inside it]
+        current = [name, time.perf_counter(), 0.0]
+        self._stages.append(current)
+        try:
+            yield
+        finally:
+            self._stages.pop()
+            spent = time.perf_counter() - current[1]
+            if self._stages:
+                self._stages[-1][2] += spent
+            counters = self._scopes[-1] if self._scopes else self.total
+            counters.seconds[name] = counters.seconds.get(name, 0.0) + spent - current[2]
+
+    @contextmanager
+    def _scope(self, counters):
+        started = time.perf_counter()
+        self._scopes.append(counters)
+        try:
+            yield counters
+        finally:
+            self._scopes.pop()
+            counters.elapsed = time.perf_counter() - started
+            (self._scopes[-1] if self._scopes else self.total).add(counters)
+
+    @contextmanager
+    def call(self, name):
+        """Counters of one trace call, nested calls are folded into the outermost one"""
+        if any(scope.name != "frame" for scope in self._scopes):
+            yield None
+            return
+        frame = self._scopes[-1] if self._scopes else None
+        with self._scope(Counters(name)) as counters:
+            yield counters
+        self.last_call = counters
+        if frame is not None:
+            frame.calls.append(counters)
+        elif self.exporter is not None:
+            self.exporter(counters)
+
+    @contextmanager
+    def frame(self):
+        """Counters of every trace call made inside, exported when the frame ends"""
+        with self._scope(Counters("frame")) as counters:
+            yield counters
+        self.last_frame = counters
+        if self.exporter is not None:
+            self.exporter(counters)
+
+
+def count(name, n=1):
+    """Adds n to a counter of the active profiler"""
+    if active is not None:
+        active.count(name, n)
+
+
+def stage(name):
+    """Times a stage on the active profiler, does nothing when there is none"""
+    if active is None:
+        return _NOTHING
+    return active.stage(name)
+
+
+def call(name):
+    """Scopes a trace call on the active profiler, does nothing when there is none"""
+    if active is None:
+        return _NOTHING
+    return active.call(name)
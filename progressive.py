@@ -0,0 +1,128 @@
+"""
+Progressive tracing for interactive use. While the transmitter moves only a coarse, shallow fan is traced;
+once it stops, finer levels with more rays and deeper bounces are traced a little every frame
+and each one replaces the last as soon as it is complete.
+"""
+import time
+import numpy as np
+from block import Map
+from tracer import fan_directions
+from packet import Segments, stream_packet
+from session import TraceSession
+
+# (rays, bounce depth) of each level, coarsest first
+DEFAULT_LEVELS = ((36, 1), (144, 3), (576, 4), (2304, 5))
+
+# Batches are sized so tracing one generation of one takes about this share of frame_budget
+UNIT_SHARE = 0.25
+
+# Finished generations are joined this many at a time, so completing a level never joins thousands of parts
+MERGE_PARTS = 32
+
+
+class ProgressiveTracer:
+    """
+    Traces a point source fan at increasing levels of detail.
+    move gives the coarse fan of levels[0] for a new pose straight away, traced with a TraceSession so
+    small moves are cheap. step then spends about frame_budget seconds a call on the next level and
+    returns its segments once it is done. A level is traced in batches of head rays, one generation at a time,
+    and each level's batch size is grown or shrunk from how long its generations took so one fits in the budget.
+    The finest level is only ever shown after a full trace, so the final picture has the same segments
+    trace_packet gives for it (in batch order)
+    """
+    def __init__(self, room_map: Map, levels=DEFAULT_LEVELS, frame_budget=0.008, power_threshold=0):
+        self.room_map = room_map
+        self.levels = levels
+        self.frame_budget = frame_budget
+        self.power_threshold = power_threshold
+        self.session = TraceSession(room_map, levels[0][1], power_threshold)
+        self.origin = None
+        self.angle = 0
+        self.segments = None
+        # Index into levels of self.segments, -1 before the first move
+        self.level = -1
+        # Head rays per batch for each level, kept between moves
+        self.batch_rays = [1] * len(levels)
+        self._directions = None
+        self._batch = None
+
+    @property
+    def finished(self):
+        """True once the finest level is showing"""
+        return self.level == len(self.levels) - 1
+
+    def move(self, origin, angle=0) -> Segments:
+        """Traces the coarse level for a new pose (angle in degrees) and starts refining from it"""
+        self.origin = np.array(origin, dtype=float)
+        self.angle = angle
+        rays = self.levels[0][0]
+        self.segments = self.session.trace(np.tile(self.origin, (rays, 1)), fan_directions(rays, angle))
+        self.level = 0
+        self._start(1)
+        return self.segments
+
+    def _start(self, level):
+        self._parts = []
+        self._pending = []
+        self._rows = 0
+        self._next_ray = 0
+        self._batch = None
+        self._directions = None
+        if level < len(self.levels):
+            self._directions = fan_directions(self.levels[level][0], self.angle)
+
+    def _open_batch(self):
+        level = self.level + 1
+        lo = self._next_ray
+        hi = min(lo + self.batch_rays[level], len(self._directions))
+        self._batch = stream_packet(self.room_map, np.tile(self.origin, (hi - lo, 1)), self._directions[lo:hi],
+                                    iterations=self.levels[level][1], power_threshold=self.power_threshold,
+                                    batch_rays=hi - lo)
+        self._batch_source = lo
+        self._batch_row = self._rows
+        self._slowest = 0.0
+        self._next_ray = hi
+
+    def _close_batch(self):
+        # Aim the next batch's slowest generation at UNIT_SHARE of the budget
+        level = self.level + 1
+        target = self.frame_budget * UNIT_SHARE
+        scale = min(max(target / max(self._slowest, 1e-6), 0.25), 4)
+        self.batch_rays[level] = max(1, int(self.batch_rays[level] * scale))
+        self._batch = None
+
+    def step(self):
+        """
+        Refines for about frame_budget seconds, at least one generation of one batch.
+        Returns the Segments of the next level when it completes, None otherwise
+        """
+        if self._directions is None:
+            return None
+        deadline = time.perf_counter() + self.frame_budget
+        while True:
+            if self._batch is None:
+                if self._next_ray == len(self._directions):
+                    parts = self._parts + self._pending
+                    self.segments = Segments.concatenate(parts) if parts else Segments.empty()
+                    self.level += 1
+                    self._start(self.level + 1)
+                    return self.segments
+                self._open_batch()
+            started = time.perf_counter()
+            try:
+                segments, hits = next(self._batch)
+            except StopIteration:
+                self._close_batch()
+                continue
+            # Each batch numbers its rows and head rays from 0, shift them to the level's
+            segments.source = segments.source + self._batch_source
+            segments.parent = np.where(segments.parent >= 0, segments.parent + self._batch_row, -1)
+            self._pending.append(segments)
+            if len(self._pending) == MERGE_PARTS:
+                self._parts.append(Segments.concatenate(self._pending))
+                self._pending = []
+            self._rows += len(segments)
+            now = time.perf_counter()
+            self._slowest = max(self._slowest, now - started)
+            if now + (now - started) >= deadline:
+                return None
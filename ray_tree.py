@@ -0,0 +1,144 @@
+import numpy as np
+from block import Ray
+
+# Child slots of a node
+REFLECTED = 0
+REFRACTED = 1
+
+
+class RayTree:
+    """
+    Bounce tree of one head ray held in flat arrays, one row per ray.
+    Rows are numbered breadth first as the tree is traced, so node 0 is the head ray and every generation
+    is a contiguous slice. A node that was expanded has two child slots, reflected then refracted,
+    holding the child's row or -1 where that ray doesn't exist. Unlike a heap layout only rays that
+    exist take up rows, so pruned deep trees stay small.
+    Blocks and edges are stored as indices into Map.blocks and Map.boundaries, -1 for none.
+    Only the head Ray is kept, ray() builds any other node's Ray again from its row when it is asked for
+    """
+    def __init__(self, head_ray: Ray = None, capacity=16):
+        self.size = 0
+        self.head = head_ray
+        self.room_map = None if head_ray is None else head_ray.room_map
+        self.start = np.zeros((capacity, 2))
+        self.end = np.zeros((capacity, 2))
+        self.direction = np.zeros((capacity, 2))
+        self.power = np.zeros(capacity)
+        self.end_power = np.zeros(capacity)
+        self.travelled = np.zeros(capacity)
+        self.param = np.zeros(capacity)
+        self.path_length = np.zeros(capacity)
+        self.medium = np.zeros(capacity, dtype=int)
+        self.hit_block = np.zeros(capacity, dtype=int)
+        self.edge = np.zeros(capacity, dtype=int)
+        self.parent = np.zeros(capacity, dtype=int)
+        self.generation = np.zeros(capacity, dtype=int)
+        self.children = np.zeros((capacity, 2), dtype=int)
+        self.expanded = np.zeros(capacity, dtype=bool)
+        if head_ray is not None:
+            self._add(head_ray, -1)
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return f"RayTree({self.size} rays)"
+
+    def _grow(self):
+        for field in ("start", "end", "direction", "power", "end_power", "travelled", "param", "path_length", "medium",
+                      "hit_block", "edge", "parent", "generation", "children", "expanded"):
+            old = getattr(self, field)
+            new = np.zeros((2 * len(old),) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, field, new)
+
+    def _add(self, ray: Ray, parent):
+        if self.size == len(self.power):
+            self._grow()
+        node = self.size
+        block_indices = ray.room_map.block_indices
+        self.start[node] = ray.start_point
+        self.end[node] = ray.end_point
+        self.direction[node] = ray.direction
+        self.power[node] = ray.power
+        self.end_power[node] = ray.end_power
+        self.travelled[node] = ray.travelled
+        self.param[node] = ray.shortest_path
+        self.path_length[node] = ray.path_length
+        self.medium[node] = -1 if ray.medium is None else block_indices[id(ray.medium)]
+        self.hit_block[node] = -1 if ray.hit_block is None else block_indices[id(ray.hit_block)]
+        self.edge[node] = ray.edge_index
+        self.parent[node] = parent
+        self.generation[node] = 0 if parent < 0 else self.generation[parent] + 1
+        self.children[node] = -1
+        self.expanded[node] = False
+        self.size += 1
+        return node
+
+    def expand(self, node, reflected: Ray = None, refracted: Ray = None):
+        """Gives node its reflected and refracted children, either can be None. Returns their rows (-1 for None)"""
+        rows = [-1 if ray is None else self._add(ray, node) for ray in (reflected, refracted)]
+        self.children[node] = rows
+        self.expanded[node] = True
+        return rows
+
+    def ray(self, node) -> Ray:
+        """The Ray of a node, the head ray itself for node 0 and a new Ray with the same fields for the rest"""
+        if node == 0:
+            return self.head
+        room_map = self.room_map
+        medium, hit_block, edge = int(self.medium[node]), int(self.hit_block[node]), int(self.edge[node])
+        ray = Ray.__new__(Ray)
+        ray.start_point = self.start[node].copy()
+        ray.direction = self.direction[node].copy()
+        ray._unit_direction = ray._normal = ray._unit_normal = None
+        ray.power = float(self.power[node])
+        ray.travelled = float(self.travelled[node])
+        ray.room_map = room_map
+        ray.medium = None if medium < 0 else room_map.blocks[medium]
+        ray.hit_block = None if hit_block < 0 else room_map.blocks[hit_block]
+        ray.edge_index = edge
+        ray.shortest_path = float(self.param[node])
+        ray.boundary_hit = None if edge < 0 else room_map.boundaries[edge]
+        ray.end_point = self.end[node].copy()
+        ray.path_length = float(self.path_length[node])
+        ray.end_power = float(self.end_power[node])
+        return ray
+
+    def child(self, node, slot=REFLECTED):
+        return int(self.children[node, slot])
+
+    def parent_of(self, node):
+        return int(self.parent[node])
+
+    def generation_slice(self, generation):
+        """Rows of the given generation"""
+        generations = self.generation[:self.size]
+        return slice(int(np.searchsorted(generations, generation, "left")),
+                     int(np.searchsorted(generations, generation, "right")))
+
+    def columns(self):
+        """Views (no copies) of the filled part of every array, keyed by name"""
+        return {field: getattr(self, field)[:self.size] for field in
+                ("start", "end", "direction", "power", "end_power", "travelled", "param", "path_length", "medium",
+                 "hit_block", "edge", "parent", "generation", "children", "expanded")}
+
+    def data_list(self):
+        """
+        The rays in depth first order, reflected before refracted, with None for every empty child slot
+        of an expanded node. Same list the old linked tree gave
+        """
+        if self.size == 0:
+            return [None]
+        data_list = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if node < 0:
+                data_list.append(None)
+                continue
+            data_list.append(self.ray(node))
+            if self.expanded[node]:
+                stack.append(int(self.children[node, REFRACTED]))
+                stack.append(int(self.children[node, REFLECTED]))
+        return data_list
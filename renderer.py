@@ -0,0 +1,83 @@
+"""
+pygame drawing for maps, rays and packet traces.
+Nothing else in the tracer imports pygame, so headless runs never load it.
+"""
+import numpy as np
+import pygame
+from block import Boundary, Block, Map, Ray
+
+RAY_COLOUR = (255, 255, 0)
+
+
+def draw_boundary(surface, boundary: Boundary):
+    """draws the boundary onto the surface"""
+    pygame.draw.line(surface, boundary.colour, boundary.start_coordinates, boundary.end_coordinates, 1)
+
+
+def draw_block(surface, block: Block):
+    for edge in block.edges:
+        draw_boundary(surface, edge)
+    lx, ly = zip(*block.vertices)
+    min_x, min_y, max_x, max_y = min(lx), min(ly), max(lx), max(ly)
+    target_rect = pygame.Rect(min_x, min_y, max_x - min_x, max_y - min_y)
+    shape_surf = pygame.Surface(target_rect.size, pygame.SRCALPHA)
+    pygame.draw.polygon(shape_surf, block.colour, [(x - min_x, y-min_y) for x, y in block.vertices])
+    surface.blit(shape_surf, target_rect)
+
+
+def draw_map(surface, room_map: Map):
+    for block in room_map.blocks:
+        draw_block(surface, block)
+
+
+def draw_ray(surface, ray: Ray):
+    pygame.draw.line(surface, RAY_COLOUR, ray.start_point, ray.end_point)
+
+
+def draw_segments(surface, segments, colour=RAY_COLOUR):
+    """Draws every segment of a packet trace, one pygame line each"""
+    line = pygame.draw.line
+    for x0, y0, x1, y1 in np.hstack([segments.start, segments.end]).tolist():
+        line(surface, colour, (x0, y0), (x1, y1))
+
+
+class SceneLayer:
+    """
+    Caches what the demos draw every frame.
+    The map is drawn once over a plain background and only drawn again when a Receiver changes colour,
+    blocks are taken to never change. The segments of a trace are drawn over a copy of it and kept
+    until a different Segments is passed in, so frames where nothing moved are a single blit
+    """
+    def __init__(self, room_map: Map, background=(0, 0, 0), colour=RAY_COLOUR):
+        self.room_map = room_map
+        self.background = background
+        self.colour = colour
+        self.map_layer = None
+        self.frame_layer = None
+        self._colours = None
+        self._segments = None
+        # How many times the map has been drawn
+        self.redraws = 0
+
+    def invalidate(self):
+        """Draws everything again on the next frame, for changes the receiver colours don't show"""
+        self.map_layer = None
+
+    def draw(self, surface, segments=None):
+        colours = [receiver.colour for receiver in self.room_map.receivers]
+        if self.map_layer is None or self.map_layer.get_size() != surface.get_size() or colours != self._colours:
+            # A copy has the same pixel format as the target, so blitting it is a plain copy
+            self.map_layer = surface.copy()
+            self.map_layer.fill(self.background)
+            draw_map(self.map_layer, self.room_map)
+            self._colours = colours
+            self.frame_layer = None
+            self.redraws += 1
+        if segments is None:
+            surface.blit(self.map_layer, (0, 0))
+            return
+        if self.frame_layer is None or segments is not self._segments:
+            self.frame_layer = self.map_layer.copy()
+            draw_segments(self.frame_layer, segments, self.colour)
+            self._segments = segments
+        surface.blit(self.frame_layer, (0, 0))
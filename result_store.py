@@ -0,0 +1,173 @@
+"""
+On disk storage for segments from large trace runs. A store is a folder of .npy chunks of fixed dtype
+records, written as the trace goes so the segments never all have to fit in memory:
+
+    with SegmentWriter("run") as writer:
+        for origins, directions in batches:
+            writer.write(trace_packet(room_map, origins, directions))
+    reader = SegmentReader("run")
+    powers = reader[1000000:2000000]["power"]
+
+Each writer fills chunks named after its prefix, so several processes can write into one store at once
+as long as their prefixes differ. Chunks only appear once fully written. Readers memory map the chunks
+in name order and only touch the pages of the rows they are asked for
+"""
+import json
+import os
+import numpy as np
+
+# One record per segment, little endian so stores can be shared between machines
+segment_dtype = np.dtype([("start", "<f8", (2,)), ("end", "<f8", (2,)), ("power", "<f8"), ("end_power", "<f8"),
+                          ("medium", "<i4"), ("hit_block", "<i4"), ("edge", "<i4"), ("source", "<i8"),
+                          ("generation", "<i4"), ("kind", "<i1")])
+
+STORE_VERSION = 1
+
+# About 70 MB of records per chunk
+DEFAULT_CHUNK_ROWS = 1 << 20
+
+
+def segment_records(segments, source_offset=0):
+    """The rows of a Segments as a segment_dtype array, source_offset is added to every source"""
+    records = np.empty(len(segments), dtype=segment_dtype)
+    for field in segment_dtype.names:
+        records[field] = getattr(segments, field)
+    records["source"] += source_offset
+    return records
+
+
+def _chunk_name(prefix, number):
+    return f"{prefix}_{number:06d}.npy"
+
+
+class SegmentWriter:
+    """
+    Appends segments to the store at path, chunk_rows records to a chunk.
+    Writing to a prefix that already has chunks carries on after them. Call close (or use a with block)
+    to write out the last, partly filled chunk
+    """
+    def __init__(self, path, prefix="part", chunk_rows=DEFAULT_CHUNK_ROWS):
+        self.path = path
+        self.prefix = prefix
+        self.chunk_rows = chunk_rows
+        os.makedirs(path, exist_ok=True)
+        self._write_header()
+        existing = [name for name in os.listdir(path) if name.startswith(prefix + "_") and name.endswith(".npy")]
+        self._next_chunk = len(existing)
+        self._pending = []
+        self._pending_rows = 0
+        # Records written by this writer, flushed or not
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_header(self):
+        header = {"version": STORE_VERSION, "dtype": np.lib.format.dtype_to_descr(segment_dtype)}
+        header_path = os.path.join(self.path, "store.json")
+        if os.path.exists(header_path):
+            with open(header_path) as file:
+                if json.load(file)["version"] != STORE_VERSION:
+                    raise ValueError(f"{self.path} was written by a different version of result_store")
+            return
+        temporary = f"{header_path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(header, file)
+        os.replace(temporary, header_path)
+
+    def write(self, segments, source_offset=0):
+        """Appends a Segments (or an array of segment_dtype records)"""
+        records = segments if isinstance(segments, np.ndarray) else segment_records(segments, source_offset)
+        self._pending.append(records)
+        self._pending_rows += len(records)
+        self.rows += len(records)
+        if self._pending_rows >= self.chunk_rows:
+            pending = np.concatenate(self._pending)
+            full = len(pending) - len(pending) % self.chunk_rows
+            for lo in range(0, full, self.chunk_rows):
+                self._write_chunk(pending[lo:lo + self.chunk_rows])
+            self._pending = [pending[full:]]
+            self._pending_rows = len(pending) - full
+
+    def _write_chunk(self, records):
+        name = os.path.join(self.path, _chunk_name(self.prefix, self._next_chunk))
+        # Readers only look for .npy files, so a chunk can't be seen half written
+        temporary = name + ".tmp"
+        with open(temporary, "wb") as file:
+            np.save(file, records)
+        os.replace(temporary, name)
+        self._next_chunk += 1
+
+    def close(self):
+        if self._pending_rows:
+            self._write_chunk(np.concatenate(self._pending))
+        self._pending = []
+        self._pending_rows = 0
+
+
+class SegmentReader:
+    """
+    Reads a store as one long array of segment_dtype records.
+    Indexing with an int, a slice or an array of rows only loads those rows,
+    a slice inside one chunk gives a read only view of the memory map
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "store.json")) as file:
+            header = json.load(file)
+        if header["version"] != STORE_VERSION:
+            raise ValueError(f"{path} was written by a different version of result_store")
+        self.dtype = np.dtype(np.lib.format.descr_to_dtype(header["dtype"]))
+        self.files = sorted(name for name in os.listdir(path) if name.endswith(".npy"))
+        self._chunks = [np.load(os.path.join(path, name), mmap_mode="r") for name in self.files]
+        # Row of the store each chunk starts at, with the total at the end
+        self.offsets = np.concatenate([[0], np.cumsum([len(chunk) for chunk in self._chunks], dtype=np.int64)])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __repr__(self):
+        return f"SegmentReader({self.path!r}, {len(self)} segments in {len(self._chunks)} chunks)"
+
+    def chunks(self):
+        """The memory mapped chunks in order"""
+        return iter(self._chunks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            lo, hi, step = index.indices(len(self))
+            if step != 1:
+                return self[np.arange(lo, hi, step)]
+            return self._range(lo, hi)
+        if np.ndim(index) == 0:
+            row = int(index)
+            if row < 0:
+                row += len(self)
+            if not 0 <= row < len(self):
+                raise IndexError(f"row {index} is out of range for {len(self)} segments")
+            chunk = int(np.searchsorted(self.offsets, row, side="right")) - 1
+            return self._chunks[chunk][row - self.offsets[chunk]]
+        rows = np.asarray(index, dtype=np.int64)
+        rows = np.where(rows < 0, rows + len(self), rows)
+        if np.any((rows < 0) | (rows >= len(self))):
+            raise IndexError(f"rows out of range for {len(self)} segments")
+        chunk_of = np.searchsorted(self.offsets, rows, side="right") - 1
+        result = np.empty(len(rows), dtype=self.dtype)
+        for chunk in np.unique(chunk_of):
+            picked = np.flatnonzero(chunk_of == chunk)
+            result[picked] = self._chunks[chunk][rows[picked] - self.offsets[chunk]]
+        return result
+
+    def _range(self, lo, hi):
+        if hi <= lo:
+            return np.empty(0, dtype=self.dtype)
+        first = int(np.searchsorted(self.offsets, lo, side="right")) - 1
+        last = int(np.searchsorted(self.offsets, hi - 1, side="right")) - 1
+        if first == last:
+            return self._chunks[first][lo - self.offsets[first]:hi - self.offsets[first]]
+        parts = [self._chunks[chunk][max(lo - self.offsets[chunk], 0):hi - self.offsets[chunk]]
+                 for chunk in range(first, last + 1)]
+        return np.concatenate(parts)
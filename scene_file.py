@@ -0,0 +1,164 @@
+"""
+Scenes stored as JSON or TOML files instead of Python. A scene lists its blocks in Map order
+(the first block wins where blocks overlap), the transmitters and the trace settings:
+
+    {
+      "settings": {"iterations": 3, "power_threshold": 0, "accelerator": "bvh"},
+      "transmitters": [{"origin": [50, 50], "rays": 360, "angle": 0, "power": 1}],
+      "blocks": [
+        {"name": "lens", "receiver": true, "refraction_index": 1.2, "init_colour": [255, 255, 255, 255],
+         "receive_colour": [100, 100, 100, 255], "absorption_coeff": 1, "reflectivity": null,
+         "vertices": [[440, 400], [420, 340], [470, 340]]},
+        {"name": "room", "refraction_index": 1, "colour": [0, 0, 0, 127], "absorption_coeff": 1,
+         "reflectivity": 1, "vertices": [[0, 0], [1000, 0], [1000, 500], [0, 500]]}
+      ]
+    }
+
+A transmitter is a fan of rays spread evenly over 360 degrees starting at angle, one ray gives a single beam.
+Leaving out reflectivity (TOML has no null) uses the Fresnel equations, leaving out max_segments or
+accelerator means none. load_scene keeps what Map.compiled gives in an .npz file named after a hash
+of the scene, so only the first load of a scene works out its edge tables and accelerator
+"""
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+import numpy as np
+from block import Block, Map, Receiver
+from tracer import fan_directions
+
+# Part of every scene hash, bump it when the compiled arrays change so old caches are ignored
+COMPILED_VERSION = 1
+
+DEFAULT_SETTINGS = {"iterations": 3, "power_threshold": 0, "max_segments": None, "accelerator": None}
+DEFAULT_TRANSMITTER = {"rays": 1, "angle": 0, "power": 1}
+
+
+class Scene:
+    """A loaded scene file: the Map, the transmitters as dicts and the trace settings with defaults filled in"""
+    def __init__(self, room_map: Map, transmitters, settings, scene_hash):
+        self.room_map = room_map
+        self.transmitters = transmitters
+        self.settings = settings
+        self.hash = scene_hash
+
+    def __repr__(self):
+        return f"Scene({len(self.room_map.blocks)} blocks, {len(self.transmitters)} transmitters)"
+
+    def rays(self):
+        """Origins, unit directions and powers of every transmitter's rays, ready for trace_packet"""
+        origins, directions, powers = [], [], []
+        for transmitter in self.transmitters:
+            fan = fan_directions(transmitter["rays"], transmitter["angle"])
+            directions.append(fan)
+            origins.append(np.tile(np.asarray(transmitter["origin"], dtype=float), (len(fan), 1)))
+            powers.append(np.full(len(fan), float(transmitter["power"])))
+        if not origins:
+            return np.zeros((0, 2)), np.zeros((0, 2)), np.zeros(0)
+        return np.concatenate(origins), np.concatenate(directions), np.concatenate(powers)
+
+
+def read_scene(path):
+    """The raw scene dict of a .json or .toml file"""
+    if path.endswith(".toml"):
+        import tomllib
+        with open(path, "rb") as file:
+            return tomllib.load(file)
+    with open(path) as file:
+        return json.load(file)
+
+
+def scene_hash(scene):
+    """Hash of everything in a scene dict that the compiled arrays depend on"""
+    key = {"version": COMPILED_VERSION, "blocks": scene.get("blocks", []),
+           "accelerator": scene.get("settings", {}).get("accelerator")}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def build_blocks(scene):
+    """The Block and Receiver objects of a scene dict, in file order"""
+    blocks = []
+    for entry in scene.get("blocks", []):
+        vertices = [tuple(vertex) for vertex in entry["vertices"]]
+        reflectivity = entry.get("reflectivity")
+        if entry.get("receiver", False):
+            blocks.append(Receiver(entry["name"], entry["refraction_index"], tuple(entry["init_colour"]),
+                                   tuple(entry["receive_colour"]), entry["absorption_coeff"], reflectivity,
+                                   vertices))
+        else:
+            blocks.append(Block(entry["name"], entry["refraction_index"], tuple(entry["colour"]),
+                                entry["absorption_coeff"], reflectivity, vertices))
+    return blocks
+
+
+def _read_cache(path):
+    try:
+        with np.load(path) as data:
+            return dict(data)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def _write_cache(path, compiled):
+    # Write to a temporary file first so other processes never load half a cache
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix=".npz")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            np.savez(file, **compiled)
+        os.replace(temporary, path)
+    except OSError:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def load_scene(path, cache=True, cache_dir=None) -> Scene:
+    """
+    Loads a scene file and builds its Map.
+    Unless cache is False the compiled arrays are kept in cache_dir, by default a .scene_cache folder
+    next to the scene file. A missing or unreadable cache is simply rebuilt
+    """
+    scene = read_scene(path)
+    settings = {**DEFAULT_SETTINGS, **scene.get("settings", {})}
+    transmitters = [{**DEFAULT_TRANSMITTER, **transmitter} for transmitter in scene.get("transmitters", [])]
+    key = scene_hash(scene)
+    blocks = build_blocks(scene)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), ".scene_cache")
+    cache_path = os.path.join(cache_dir, f"{key}.npz") if cache else None
+
+    compiled = None if cache_path is None else _read_cache(cache_path)
+    try:
+        room_map = Map(*blocks, accelerator=settings["accelerator"], compiled=compiled)
+    except (ValueError, KeyError):
+        if compiled is None:
+            raise
+        # The cache doesn't fit the scene after all
+        compiled = None
+        room_map = Map(*blocks, accelerator=settings["accelerator"])
+    if compiled is None and cache_path is not None:
+        _write_cache(cache_path, room_map.compiled())
+    return Scene(room_map, transmitters, settings, key)
+
+
+def scene_dict(room_map: Map, transmitters=(), settings=None):
+    """A scene dict for an existing Map, the inverse of build_blocks"""
+    blocks = []
+    for block in room_map.blocks:
+        entry = {"name": block.name}
+        if isinstance(block, Receiver):
+            entry.update(receiver=True, init_colour=list(block.init_colour), receive_colour=list(block.receive_colour))
+        else:
+            entry["colour"] = list(block.colour)
+        entry.update(refraction_index=block.refraction_index, absorption_coeff=block.absorption_coeff,
+                     reflectivity=block.reflectivity, vertices=[vertex.tolist() for vertex in block.vertices])
+        blocks.append(entry)
+    return {"settings": dict(settings or {}), "transmitters": [dict(t) for t in transmitters], "blocks": blocks}
+
+
+def save_scene(path, room_map: Map, transmitters=(), settings=None):
+    """Writes a Map and its transmitters as a JSON scene file"""
+    with open(path, "w") as file:
+        json.dump(scene_dict(room_map, transmitters, settings), file, indent=2)
@@ -0,0 +1,127 @@
+from block import Block, Map, Receiver
+
+# Demo scenes shared by the pygame demos and the headless trace_cli
+
+
+def get_square(top_left_corner, side_length):
+    corner1 = top_left_corner
+    corner2 = (top_left_corner[0] + side_length, top_left_corner[1])
+    corner3 = (top_left_corner[0] + side_length, top_left_corner[1] + side_length)
+    corner4 = (top_left_corner[0], top_left_corner[1] + side_length)
+    return (corner1, corner2, corner3, corner4)
+
+
+def point_source_map(accelerator=None):
+    square_coord = get_square((10,10), 10)
+
+    square = Block(
+        name="square",
+        refraction_index=100,
+        colour=(255,0,0, 127),
+        absorption_coeff=1,
+        reflectivity=0,
+        vertices=((10,140),(450,140),(450,390))
+    )
+
+    square_2 = Receiver(
+        name="square2",
+        refraction_index=36,
+        init_colour=(0,255,0, 127),
+        receive_colour=(0,100, 0, 127),
+        absorption_coeff=1,
+        reflectivity=0,
+        vertices=get_square((10,10), 10)
+    )
+
+    square_3 = Receiver(
+        name="square3",
+        refraction_index=36,
+        init_colour=(0,255,0, 127),
+        receive_colour=(0,100, 0, 127),
+        absorption_coeff=1,
+        reflectivity=0,
+        vertices=get_square((100,10), 10)
+    )
+
+    square_4 = Receiver(
+        name="square4",
+        refraction_index=36,
+        init_colour=(0,255,0, 127),
+        receive_colour=(0,100, 0, 127),
+        absorption_coeff=1,
+        reflectivity=0,
+        vertices=get_square((539,246), 10)
+    )
+
+    lens = Receiver(
+        name="lens",
+        refraction_index=36,
+        init_colour = (255,255,255,255),
+        receive_colour=(100,100,100,255),
+        absorption_coeff=1,
+        reflectivity=0,
+        vertices=((440, 400), (420, 340), (410, 280), (410, 220), (420, 160), (440, 100),
+                  (450, 100), (470, 160), (480, 220), (480, 280), (470, 340), (450, 400))
+    )
+
+    room = Block(
+        name="room",
+        refraction_index=1,
+        colour=(0,0,0, 127),
+        absorption_coeff=1,
+        reflectivity=1,
+        vertices=((0,0), (1000,0), (1000, 500),(0,500))
+    )
+    # When blocks overlap, the block that is at define at the start of "Map" will matter the most
+    return Map(square, square_2, square_3, square_4, accelerator=accelerator)
+
+
+def parallel_rays_map(accelerator=None):
+    square_coord = get_square((10,10), 50)
+
+    square = Block(
+        name="square",
+        refraction_index=1.2,
+        colour=(255,0,0, 127),
+        absorption_coeff=1,
+        reflectivity=0,
+        vertices=((10,140),(450,140),(450,390))
+    )
+
+    square_2 = Receiver(
+        name="square2",
+        refraction_index=36,
+        init_colour=(0,255,0, 127),
+        receive_colour=(0,100, 0, 127),
+        absorption_coeff=1,
+        reflectivity=0,
+        vertices=square_coord
+    )
+
+    lens = Receiver(
+        name="lens",
+        refraction_index=1.2,
+        init_colour = (255,255,255,255),
+        receive_colour=(100,100,100,255),
+        absorption_coeff=1,
+        reflectivity=0,
+        vertices=((440, 400), (420, 340), (410, 280), (410, 220), (420, 160), (440, 100),
+                  (450, 100), (470, 160), (480, 220), (480, 280), (470, 340), (450, 400))
+    )
+
+    room = Block(
+        name="room",
+        refraction_index=1,
+        colour=(0,0,0, 127),
+        absorption_coeff=1,
+        reflectivity=1,
+        vertices=((0,0), (1000,0), (1000, 500),(0,500))
+    )
+    # When blocks overlap, the block that is at define at the start of "Map" will matter the most
+    return Map(lens, accelerator=accelerator)
+
+
+SCENES = {
+    "point_source": point_source_map,
+    "parallel_rays": parallel_rays_map,
+}
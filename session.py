@@ -0,0 +1,218 @@
+"""
+Incremental retracing for interactive use. A TraceSession keeps the last packet trace and when
+the transmitters move or turn a little, re-solves each segment against the boundary it hit
+last time instead of searching every boundary again.
+"""
+import numpy as np
+import profiler
+from block import Map
+from intersect import row_edge_params, valid_hits, nearest_hits
+from packet import Segments, _trace_generations, HEAD
+
+# Slack of the sweep test relative to the size of the map, vertices this close to a swept area count as inside
+SWEEP_TOLERANCE = 1e-9
+
+# Most candidate (segment, vertex) pairs the sweep test looks at in one go
+MAX_PAIRS = 1 << 20
+
+# Below this many boundaries searching them all is cheaper than checking the old hits
+MIN_MATCH_EDGES = 256
+
+
+class TraceSession:
+    """
+    Traces the same set of rays again and again as the transmitters move, giving what trace_packet gives.
+    Each new segment is matched with the segment in the last trace that took the same path
+    (same head ray, same reflections and refractions). The old and new segment sweep out an area;
+    if no vertex of the map lies in it and neither the boundary the segment starts on nor the one it
+    hits touches another block, nothing can have come between them and the segment still hits the
+    same boundary. Only segments failing that test, or whose path is new, search every boundary.
+    Hits closer than MIN_PARAM to a segment's start are the one thing the test can't see,
+    apart from the edges next to the boundary the segment starts on which are checked directly.
+    Maps with fewer than MIN_MATCH_EDGES boundaries are simply searched every time
+    """
+    def __init__(self, room_map: Map, iterations=3, power_threshold=0, max_segments=None):
+        self.room_map = room_map
+        self.iterations = iterations
+        self.power_threshold = power_threshold
+        self.max_segments = max_segments
+        ends = room_map.edge_starts + room_map.edge_directions
+        vertices = np.unique(np.concatenate([room_map.edge_starts, ends]), axis=0)
+        # Sorted copies so the vertices near a segment can be found with a binary search along either axis
+        self.vertices_x = vertices[np.argsort(vertices[:, 0], kind="stable")]
+        self.vertices_y = vertices[np.argsort(vertices[:, 1], kind="stable")]
+        # The edges before and after each edge in its block, which share its vertices
+        offsets = np.searchsorted(room_map.edge_blocks, np.arange(len(room_map.blocks) + 1))
+        edges = np.arange(len(room_map.edge_blocks))
+        first, last = offsets[room_map.edge_blocks], offsets[room_map.edge_blocks + 1] - 1
+        self.neighbours = np.stack([np.where(edges > first, edges - 1, last),
+                                    np.where(edges < last, edges + 1, first)], axis=1)
+        scale = float(np.ptp(vertices, axis=0).max()) if len(vertices) else 1.0
+        self.slack = SWEEP_TOLERANCE * scale
+        self.area_slack = SWEEP_TOLERANCE * scale * scale
+        self.reset()
+
+    def reset(self):
+        """Forgets the last trace, the next call searches everything"""
+        self.segments = None
+        self.origins = None
+        # Segments of the last call that had to search every boundary
+        self.searched = 0
+
+    def trace(self, origins, directions, powers=1) -> Segments:
+        """Same arguments and result as trace_packet, with the session's pruning settings"""
+        with profiler.call("TraceSession.trace"):
+            room_map = self.room_map
+            origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+            directions = np.asarray(directions, dtype=float).reshape(-1, 2)
+            directions = directions / np.linalg.norm(directions, axis=1)[:, None]
+            powers = np.broadcast_to(np.asarray(powers, dtype=float), (len(origins),)).copy()
+            num_rays = len(origins)
+
+            old = self.segments
+            if old is None or self.origins.shape != origins.shape or len(room_map.boundaries) < MIN_MATCH_EDGES:
+                old = None
+                heads = np.full(num_rays, -1)
+                medium = room_map.blocks_enclosed(origins, directions)
+            else:
+                # Head rays line up with the last call, unless the transmitter moved through a boundary
+                heads = np.arange(num_rays)
+                medium = old.medium[:num_rays].copy()
+                moved = np.flatnonzero(np.any(origins != self.origins, axis=1))
+                if len(moved):
+                    edges, params = nearest_hits(self.origins[moved], origins[moved] - self.origins[moved],
+                                                 room_map.edge_starts, room_map.edge_directions, -self.slack)
+                    crossed = moved[(edges >= 0) & (params <= 1 + self.slack)]
+                    heads[crossed] = -1
+                    medium[crossed] = room_map.blocks_enclosed(origins[crossed], directions[crossed])
+                # Row of the reflected and refracted child of every old segment, -1 for none
+                self._children = np.full((len(old), 3), -1)
+                child = np.flatnonzero(old.parent >= 0)
+                self._children[old.parent[child], old.kind[child]] = child
+
+            self._old = old
+            self._matches = heads
+            self._edges = None
+            self._offset = 0
+            self._next = 0
+            self.searched = 0
+            segments = _trace_generations(room_map, origins, directions, powers, medium, self.iterations,
+                                          self.power_threshold, self.max_segments, self._find_hits)
+            self._old = self._matches = self._edges = self._children = None
+            self.segments = segments
+            self.origins = origins
+            return segments
+
+    def _find_hits(self, start, direction, parent, kind):
+        """find_hits for _trace_generations, tries each segment's old boundary before searching them all"""
+        room_map, old = self.room_map, self._old
+        count = len(start)
+        edge = np.full(count, -1)
+        param = np.full(count, np.inf)
+        if old is None:
+            matches = np.full(count, -1)
+        elif kind[0] == HEAD:
+            matches = self._matches
+        else:
+            # A child matches the old child of the same kind, if its parent hit the same boundary as before
+            previous = parent - self._offset
+            parent_match = self._matches[previous]
+            same = (parent_match >= 0) & (self._edges[previous] == old.edge[parent_match])
+            matches = np.where(same, self._children[parent_match, kind], -1)
+
+        rows = np.flatnonzero(matches >= 0)
+        if len(rows):
+            rows = rows[old.edge[matches[rows]] >= 0]
+        if len(rows):
+            match = matches[rows]
+            parent_edges = None if kind[0] == HEAD else self._edges[parent[rows] - self._offset]
+            with profiler.stage("match"):
+                kept, params = self._still_hits(start[rows], direction[rows], match, parent_edges)
+            edge[rows[kept]] = old.edge[match[kept]]
+            param[rows[kept]] = params[kept]
+
+        search = np.flatnonzero(edge < 0)
+        if len(search):
+            edge[search], param[search] = room_map.nearest_boundaries(start[search], direction[search])
+        self.searched += len(search)
+        profiler.count("session_searched", len(search))
+        self._matches = matches
+        self._edges = edge
+        self._offset = self._next
+        self._next += count
+        return edge, param
+
+    def _still_hits(self, start, direction, match, parent_edges):
+        """
+        Checks whether segments from start along direction still hit the boundary their old segments
+        (rows match of the old trace) hit. parent_edges is the boundary each one starts on, None for head rays.
+        Returns a mask of the ones that do and their params
+        """
+        room_map, old = self.room_map, self._old
+        edge = old.edge[match]
+        t, u = row_edge_params(start, direction, room_map.edge_starts[edge], room_map.edge_directions[edge])
+        with np.errstate(invalid="ignore"):
+            kept = valid_hits(t, u) & room_map.edge_exact[edge]
+        if parent_edges is not None:
+            kept &= room_map.edge_exact[parent_edges]
+            # Edges sharing a vertex with the one the segment starts on can sit inside the MIN_PARAM
+            # gap of the old segment, where the sweep test can't see them
+            for neighbour in self.neighbours[parent_edges].T:
+                t_n, u_n = row_edge_params(start, direction, room_map.edge_starts[neighbour],
+                                           room_map.edge_directions[neighbour])
+                with np.errstate(invalid="ignore"):
+                    kept &= ~((neighbour != edge) & valid_hits(t_n, u_n) & (t_n <= t))
+        end = start + np.where(kept, t, 0)[:, None] * direction
+        moved = kept & (np.any(start != old.start[match], axis=1) | np.any(end != old.end[match], axis=1))
+        moved = np.flatnonzero(moved)
+        kept[moved] = ~self._swept_vertices(old.start[match[moved]], old.end[match[moved]], end[moved], start[moved])
+        return kept, t
+
+    def _swept_vertices(self, old_start, old_end, new_end, new_start):
+        """
+        Mask of the segments with a map vertex in the convex hull of their old and new positions.
+        Candidate vertices come from a binary search along whichever axis gives fewer of them
+        """
+        num_rows = len(old_start)
+        result = np.zeros(num_rows, dtype=bool)
+        if num_rows == 0 or len(self.vertices_x) == 0:
+            return result
+        corners = np.stack([old_start, old_end, new_end, new_start], axis=1)
+        low = corners.min(axis=1) - self.slack
+        high = corners.max(axis=1) + self.slack
+        lo_x = np.searchsorted(self.vertices_x[:, 0], low[:, 0], "left")
+        hi_x = np.searchsorted(self.vertices_x[:, 0], high[:, 0], "right")
+        lo_y = np.searchsorted(self.vertices_y[:, 1], low[:, 1], "left")
+        hi_y = np.searchsorted(self.vertices_y[:, 1], high[:, 1], "right")
+        use_y = hi_y - lo_y < hi_x - lo_x
+        first = np.where(use_y, lo_y, lo_x)
+        counts = np.where(use_y, hi_y - lo_y, hi_x - lo_x)
+        totals = np.cumsum(counts)
+
+        row = 0
+        while row < num_rows:
+            done = totals[row] - counts[row]
+            stop = max(int(np.searchsorted(totals, done + MAX_PAIRS, "right")), row + 1)
+            rows = np.repeat(np.arange(row, stop), counts[row:stop])
+            index = first[rows] + np.arange(len(rows)) - np.repeat(totals[row:stop] - counts[row:stop] - done,
+                                                                  counts[row:stop])
+            points = np.where(use_y[rows, None], self.vertices_y[index], self.vertices_x[index])
+            inside = np.all((points >= low[rows]) & (points <= high[rows]), axis=1)
+            rows, points = rows[inside], points[inside]
+            hull = corners[rows]
+            # The hull of four points is covered by the four triangles they make
+            in_hull = np.zeros(len(rows), dtype=bool)
+            for a, b, c in ((0, 1, 2), (0, 1, 3), (0, 2, 3), (1, 2, 3)):
+                in_hull |= _in_triangle(points, hull[:, a], hull[:, b], hull[:, c], self.area_slack)
+            result[rows[in_hull]] = True
+            row = stop
+        return result
+
+
+def _in_triangle(points, a, b, c, slack):
+    """Row-wise test of points in or on triangles abc, either winding"""
+    def side(p, q, r):
+        return (q[:, 0] - p[:, 0]) * (r[:, 1] - p[:, 1]) - (q[:, 1] - p[:, 1]) * (r[:, 0] - p[:, 0])
+    d1, d2, d3 = side(a, b, points), side(b, c, points), side(c, a, points)
+    return (((d1 >= -slack) & (d2 >= -slack) & (d3 >= -slack))
+            | ((d1 <= slack) & (d2 <= slack) & (d3 <= slack)))
@@ -0,0 +1,83 @@
+"""
+Headless tracing. Loads a scene, fires a fan of rays from each origin and writes the
+segments and receiver link budget to a .npz file. Never imports pygame.
+
+    python trace_cli.py --scene point_source --origin 50 50 --rays 360 --output out.npz
+
+--scene-file loads a JSON or TOML scene (see scene_file.py) instead, its transmitters and settings
+are used unless --origin or the matching option is given
+"""
+import argparse
+import json
+import numpy as np
+from profiler import Profiler
+from scenes import SCENES
+from scene_file import load_scene, DEFAULT_SETTINGS
+from packet import trace_packet
+from link_budget import LinkBudget
+from tracer import fan_directions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Trace a scene without a display and save the results")
+    parser.add_argument("--scene", choices=sorted(SCENES), default="point_source")
+    parser.add_argument("--scene-file", help="JSON or TOML scene file to trace instead of --scene")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the scene file's compiled cache")
+    parser.add_argument("--origin", type=float, nargs=2, action="append", metavar=("X", "Y"),
+                        help="transmitter position, can be given more than once (default 50 50)")
+    parser.add_argument("--rays", type=int, default=10, help="rays in the fan from each origin")
+    parser.add_argument("--angle", type=float, default=0, help="angle of the first ray in degrees")
+    parser.add_argument("--iterations", type=int, default=None, help="default 3")
+    parser.add_argument("--power-threshold", type=float, default=None, help="default 0")
+    parser.add_argument("--max-segments", type=int, default=None)
+    parser.add_argument("--accelerator", choices=["bvh", "grid"], default=None,
+                        help="for --scene, scene files give their own in settings")
+    parser.add_argument("--output", required=True, help="path of the .npz file to write")
+    parser.add_argument("--profile", action="store_true", help="print the tracer's counters as JSON")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    settings = dict(DEFAULT_SETTINGS)
+    powers = 1
+    if args.scene_file is None:
+        room_map = SCENES[args.scene](accelerator=args.accelerator)
+    else:
+        scene = load_scene(args.scene_file, cache=not args.no_cache)
+        room_map = scene.room_map
+        settings.update(scene.settings)
+    # Options given on the command line win over the scene file's settings
+    for name in ("iterations", "power_threshold", "max_segments"):
+        if getattr(args, name) is not None:
+            settings[name] = getattr(args, name)
+
+    if args.scene_file is not None and args.origin is None:
+        all_origins, all_directions, powers = scene.rays()
+    else:
+        origins = np.array(args.origin or [[50, 50]], dtype=float)
+        directions = fan_directions(args.rays, args.angle)
+        all_origins = np.repeat(origins, len(directions), axis=0)
+        all_directions = np.tile(directions, (len(origins), 1))
+    segments = trace_packet(room_map, all_origins, all_directions, powers, iterations=settings["iterations"],
+                            power_threshold=settings["power_threshold"], max_segments=settings["max_segments"])
+    budget = LinkBudget(room_map)
+    budget.record_segments(segments)
+    columns = {field: getattr(segments, field) for field in segments.fields}
+    np.savez(args.output, receivers=budget.table(), paths=budget.paths(), **columns)
+    return segments, budget
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = Profiler(exporter=lambda counters: print(json.dumps(counters.as_dict(), indent=2)))
+    if args.profile:
+        profiler.start()
+    segments, budget = run(args)
+    profiler.stop()
+    print(f"{len(segments)} segments written to {args.output}")
+    for row in budget.table():
+        print(f"{row['name']}: power {row['power']:.6g}, hits {row['hits']}, first path {row['first_path']:.6g}")
+
+
+if __name__ == "__main__":
+    main()
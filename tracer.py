@@ -1,30 +1,88 @@
+from collections import deque
 import numpy as np
-from bin_list import Node, BinTree
+import profiler
 from block import Ray, Receiver
+from ray_tree import RayTree
 
 def find_direction(angle):
     return np.array([np.cos(angle*np.pi/180), np.sin(angle*np.pi/180)])
 
-def trace_ray(ray_node: Node, iteration):
-    if iteration == 0 or ray_node is None:
-        return None
-    iteration -= 1
-    ray_data = ray_node.data
-    if ray_data is not None:
-        reflected_ray = ray_data.reflect()
-        refracted_ray = ray_data.refract()
-        reflected_node = Node(reflected_ray)
-        refracted_node = Node(refracted_ray)
-        ray_node.add_point(reflected_node, refracted_node)
-        trace_ray(reflected_node, iteration)
-        trace_ray(refracted_node, iteration)    
+def fan_directions(number_of_rays, offset=0):
+    """Unit directions spread evenly over 360 degrees, like the point_source fan"""
+    angles = np.radians(offset + 360 / number_of_rays * np.arange(number_of_rays))
+    return np.stack([np.cos(angles), np.sin(angles)], axis=1)
 
-def get_all_rays(head_ray: Ray, iterations=3):
-    head_node = Node(head_ray)
-    trace_ray(head_node, iterations)
-    tree = BinTree(head_node)
-    data_list = tree.get_data_list()
-    return data_list
+def trace_ray(tree: RayTree, iteration, power_threshold=0, max_segments=None, budget=None, source=0):
+    """
+    Grows the bounce tree under the head ray of tree one generation at a time from a work queue.
+    A ray only spawns children while the power reaching its end is at least power_threshold,
+    iteration is a hard cap on the depth and max_segments a cap on the rays in the tree.
+    Every ray is recorded in budget (a LinkBudget) as it is traced.
+    Returns how many rays are in the tree
+    """
+    if len(tree) == 0:
+        return 0
+    segments = 1
+    if budget is not None:
+        budget.record_ray(tree.head, 0, source)
+    # The tree only keeps arrays, so the queue holds the Ray of every node still to be expanded
+    queue = deque([(0, tree.head, iteration)])
+    while queue:
+        node, ray_data, depth_left = queue.popleft()
+        if depth_left == 0 or ray_data.end_power < power_threshold:
+            continue
+        if max_segments is not None and segments >= max_segments:
+            break
+        reflected = ray_data.reflect()
+        refracted = None
+        segments += reflected is not None
+        if max_segments is None or segments < max_segments:
+            refracted = ray_data.refract()
+            segments += refracted is not None
+        for child, child_ray in zip(tree.expand(node, reflected, refracted), (reflected, refracted)):
+            if child >= 0:
+                if budget is not None:
+                    budget.record_ray(child_ray, iteration - depth_left + 1, source)
+                queue.append((child, child_ray, depth_left - 1))
+    return segments
+
+def get_all_rays(head_ray: Ray, iterations=3, power_threshold=0, max_segments=None, budget=None, source=0):
+    """
+    Traces the bounce tree of head_ray and returns it as a list in depth first order.
+    See trace_ray for how the tree is pruned and recorded
+    """
+    with profiler.call("get_all_rays"):
+        tree = RayTree(head_ray)
+        trace_ray(tree, iterations, power_threshold, max_segments, budget, source)
+        return tree.data_list()
+
+def iter_rays(head_ray: Ray, iterations=3, power_threshold=0, max_segments=None):
+    """
+    Yields (ray, generation) for every ray in the bounce tree of head_ray as soon as it is traced,
+    in the same order and with the same pruning as trace_ray.
+    Only the rays still waiting to be expanded are held in memory
+    """
+    if head_ray is None:
+        return
+    yield head_ray, 0
+    segments = 1
+    queue = deque([(head_ray, 0)])
+    while queue:
+        ray_data, generation = queue.popleft()
+        if generation == iterations or ray_data.end_power < power_threshold:
+            continue
+        if max_segments is not None and segments >= max_segments:
+            break
+        reflected = ray_data.reflect()
+        refracted = None
+        segments += reflected is not None
+        if max_segments is None or segments < max_segments:
+            refracted = ray_data.refract()
+            segments += refracted is not None
+        for child in (reflected, refracted):
+            if child is not None:
+                yield child, generation + 1
+                queue.append((child, generation + 1))
 
 def receiver_hit(med_list):
     hit_list = []
@@ -0,0 +1,106 @@
+"""
+Tracing off the display thread. The demos hand the latest transmitter pose to a TraceWorker
+and keep drawing the last finished trace, so input and drawing never wait on a slow trace.
+"""
+import threading
+
+
+class TraceWorker:
+    """
+    Runs trace(*pose) on a background thread for the latest submitted pose.
+    A pose submitted while a trace is running replaces any pose still waiting, so stale requests
+    are dropped rather than queued. poll gives each finished result once, the newest first.
+    trace must not share mutable state with the display thread (a TraceSession or LinkBudget
+    should only be used inside it), most of the time in numpy runs without the GIL
+    """
+    def __init__(self, trace):
+        self.trace = trace
+        self._condition = threading.Condition()
+        self._pose = None
+        self._result = None
+        self._error = None
+        self._submitted = 0
+        self._finished = 0
+        self._polled = 0
+        self._closed = False
+        # Poses replaced before they were traced
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="TraceWorker", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, *pose):
+        """Asks for pose to be traced. Copy anything the caller will change in place, like position lists"""
+        with self._condition:
+            if self._pose is not None:
+                self.dropped += 1
+            self._submitted += 1
+            self._pose = (self._submitted, pose)
+            self._condition.notify_all()
+
+    def poll(self):
+        """The newest result not handed out yet, None when there is nothing new"""
+        with self._condition:
+            self._raise_error()
+            if self._finished == self._polled:
+                return None
+            self._polled = self._finished
+            return self._result
+
+    def wait(self, timeout=None):
+        """Waits until the last submitted pose is traced and returns its result, None on timeout"""
+        with self._condition:
+            done = self._condition.wait_for(lambda: self._finished == self._submitted or self._error is not None,
+                                            timeout)
+            self._raise_error()
+            if not done:
+                return None
+            self._polled = self._finished
+            return self._result
+
+    @property
+    def busy(self):
+        """True while a pose is waiting or being traced"""
+        with self._condition:
+            return self._finished != self._submitted
+
+    def close(self):
+        """Stops the thread once the trace in progress finishes, waiting poses are dropped"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            # The error is what the failed pose gave, so a later poll mustn't hand out the result before it again
+            self._polled = self._finished
+            raise error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pose is not None or self._closed)
+                if self._closed:
+                    return
+                number, pose = self._pose
+                self._pose = None
+            try:
+                result = self.trace(*pose)
+            except Exception as error:
+                with self._condition:
+                    self._error = error
+                    self._finished = number
+                    self._condition.notify_all()
+                continue
+            with self._condition:
+                self._result = result
+                self._finished = number
+                self._condition.notify_all()